@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# Benchmark the default masked array reads against the --unmasked fast path on a synthetic day
+
+import os
+import sys
+import tempfile
+import numpy as np
+import netCDF4 as ncf
+from synthetic_domain import SyntheticDomain
+from wrfcmaq2inmap import cli
+
+def run(args, outfile, extra, repeats):
+    '''
+    Run the day repeats times and return the best timings
+    '''
+    best = None
+    for rep in range(repeats):
+        options, pos = cli.get_opts(extra + args + [outfile,])
+        metrics = cli.run_day(*pos, options=options)
+        if best is None or metrics['total_s'] < best['total_s']:
+            best = metrics
+    return best
+
+def main():
+    layers = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vert_layers_50_to_28.csv')
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    with tempfile.TemporaryDirectory() as path:
+        domain = SyntheticDomain(ncols=40*size, nrows=36*size, out_ncols=30*size, out_nrows=24*size)
+        args = domain.write_day(path, '20180102')
+        common = ['-m','saprc','-l',layers]
+        # Silence the processing messages
+        with open(os.devnull, 'w') as devnull:
+            stdout = sys.stdout
+            sys.stdout = devnull
+            try:
+                masked = run(args, os.path.join(path, 'masked.ncf'), common, repeats)
+                unmasked = run(args, os.path.join(path, 'unmasked.ncf'), common + ['--unmasked',], repeats)
+            finally:
+                sys.stdout = stdout
+        print('%-10s %10s %10s %8s' %('stage', 'masked s', 'unmasked s', 'speedup'))
+        for stage in ('regrid_s','alt_s','cmaq_s','total_s'):
+            print('%-10s %10.3f %10.3f %8.2f' %(stage[:-2], masked[stage], unmasked[stage],
+              masked[stage] / unmasked[stage]))
+        with ncf.Dataset(os.path.join(path, 'masked.ncf')) as a, ncf.Dataset(os.path.join(path, 'unmasked.ncf')) as b:
+            same = all(np.array_equal(a.variables[v][:], b.variables[v][:]) for v in a.variables)
+        print('Outputs identical: %s' %same)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# Writes a small synthetic WRF/MCIP/CMAQ day for testing and benchmarking wrfcmaq2inmap
+# The WRF domain is a 50 layer LCC grid and the output domain a 28 layer window inside it
+
+import os
+import sys
+import numpy as np
+import netCDF4 as ncf
+from datetime import datetime, timedelta
+from pyproj import Proj
+from wrfcmaq2inmap.vardefs import VarDefs
+
+PROJ = '+proj=lcc +lat_1=30.0 +lat_2=60.0 +lon_0=-120.5 +lat_0=37.0 +a=6370000 +b=6370000 +units=m +no_defs'
+
+class SyntheticDomain:
+    """
+    Synthetic WRF and CMAQ grids sharing one projection
+    """
+    def __init__(self, ncols=40, nrows=36, out_ncols=30, out_nrows=24, cell=4000., seed=0):
+        self.NCOLS = ncols
+        self.NROWS = nrows
+        self.OUT_NCOLS = out_ncols
+        self.OUT_NROWS = out_nrows
+        self.XCELL = cell
+        self.XORIG = -20 * cell
+        self.YORIG = -18 * cell
+        # The output window starts 5 columns and 6 rows into the WRF domain
+        self.OUT_XORIG = self.XORIG + 5 * cell
+        self.OUT_YORIG = self.YORIG + 6 * cell
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+        self.vardefs = VarDefs()
+
+    def write_wrf(self, fn, start, nsteps=24, nlays=50):
+        '''
+        Write a WRF output file with the InMAP met variables starting at a datetime
+        '''
+        with ncf.Dataset(fn, 'w', format='NETCDF3_64BIT_OFFSET') as ds:
+            ds.createDimension('Time', None)
+            ds.createDimension('DateStrLen', 19)
+            for dim, size in (('bottom_top', nlays), ('bottom_top_stag', nlays+1), ('south_north', self.NROWS),
+              ('south_north_stag', self.NROWS+1), ('west_east', self.NCOLS), ('west_east_stag', self.NCOLS+1)):
+                ds.createDimension(dim, size)
+            ds.TRUELAT1 = 30.
+            ds.TRUELAT2 = 60.
+            ds.STAND_LON = -120.5
+            ds.MOAD_CEN_LAT = 37.
+            ds.DX = ds.DY = self.XCELL
+            ds.MAP_PROJ = 1
+            ds.START_DATE = start.strftime('%Y-%m-%d_%H:%M:%S')
+            times = ds.createVariable('Times', 'S1', ('Time','DateStrLen'))
+            for step in range(nsteps):
+                stamp = (start + timedelta(hours=step)).strftime('%Y-%m-%d_%H:%M:%S')
+                times[step] = ncf.stringtochar(np.array([stamp,], 'S19'))
+            x = self.XORIG + self.XCELL * (np.arange(self.NCOLS) + 0.5)
+            y = self.YORIG + self.XCELL * (np.arange(self.NROWS) + 0.5)
+            lon, lat = Proj(PROJ)(*np.meshgrid(x, y), inverse=True)
+            for varname, arr in (('XLONG', lon), ('XLAT', lat)):
+                var = ds.createVariable(varname, np.float32, ('Time','south_north','west_east'))
+                var[:] = np.broadcast_to(arr, (nsteps,) + arr.shape)
+            metvars = dict(self.vardefs.metvars, QVAPOR=self.vardefs.metvars['T'])
+            for varname, dims in metvars.items():
+                var = ds.createVariable(varname, np.float32, dims)
+                var.description = varname
+                var.units = ''
+                var.stagger = ''
+                var.coordinates = 'XLONG XLAT'
+                shape = [nsteps,] + [ds.dimensions[dim].size for dim in dims[1:]]
+                if varname in ('PHB','PB','LU_INDEX'):
+                    # Time-invariant fields, the same in every file
+                    rng = np.random.default_rng([self.seed, len(varname), ord(varname[-1])])
+                    arr = np.broadcast_to(rng.random(shape[1:], np.float32), shape)
+                else:
+                    arr = self.rng.random(shape, np.float32)
+                var[:] = {'PB': 9e4 + arr * 1e4, 'P': arr * 100, 'T': arr * 10, 'QVAPOR': arr * 0.01,
+                  'PHB': arr * 1e4, 'LU_INDEX': np.floor(arr * 20) + 1}.get(varname, arr)
+
+    def write_ioapi(self, fn, rundate, varnames, nsteps=25, nlays=28):
+        '''
+        Write an IOAPI file on the output grid, ie. a METCRO3D or CCTM_CONC
+        '''
+        with ncf.Dataset(fn, 'w', format='NETCDF3_64BIT_OFFSET') as ds:
+            ds.createDimension('TSTEP', None)
+            ds.createDimension('LAY', nlays)
+            ds.createDimension('ROW', self.OUT_NROWS)
+            ds.createDimension('COL', self.OUT_NCOLS)
+            atts = {'GDNAM': 'SYNTHETIC', 'GDTYP': 2, 'P_ALP': 30., 'P_BET': 60., 'P_GAM': -120.5,
+              'XCENT': -120.5, 'YCENT': 37., 'XORIG': self.OUT_XORIG, 'YORIG': self.OUT_YORIG,
+              'XCELL': self.XCELL, 'YCELL': self.XCELL, 'NCOLS': self.OUT_NCOLS, 'NROWS': self.OUT_NROWS,
+              'NTHIK': 1, 'SDATE': int(rundate.strftime('%Y%j')), 'STIME': 0, 'TSTEP': 10000}
+            for att, val in atts.items():
+                setattr(ds, att, val)
+            for varname in varnames:
+                var = ds.createVariable(varname, np.float32, ('TSTEP','LAY','ROW','COL'))
+                var.long_name = varname
+                var.units = 'kg m-3' if varname == 'DENS' else 'ppmV'
+                var.var_desc = varname
+                arr = self.rng.random((nsteps, nlays, self.OUT_NROWS, self.OUT_NCOLS), np.float32)
+                var[:] = arr + 0.8 if varname == 'DENS' else arr
+
+    def cmaq_species(self):
+        '''
+        All the CMAQ species for both mechanisms
+        '''
+        species = ['NO','NO2']
+        for mech in ('cb6','saprc'):
+            self.vardefs.set_mech(mech)
+            species += self.vardefs.cmaq_species()
+        return list(dict.fromkeys(species))
+
+    def write_day(self, path, rundate):
+        '''
+        Write the WRF, METCRO3D and CCTM_CONC files for a run date (YYYYMMDD)
+        Returns the arguments for the wrfcmaq2inmap command line
+        '''
+        day = datetime.strptime(str(rundate), '%Y%m%d')
+        wrf = os.path.join(path, 'wrfout_%s' %day.strftime('%Y-%m-%d'))
+        mcip = os.path.join(path, 'METCRO3D_%s.nc' %rundate)
+        cmaq = os.path.join(path, 'CCTM_CONC_%s.nc' %rundate)
+        self.write_wrf(wrf, day, 25)
+        self.write_ioapi(mcip, day, ['DENS',])
+        self.write_ioapi(cmaq, day, self.cmaq_species())
+        return [wrf, mcip, cmaq, str(rundate)]
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        raise ValueError('./synthetic_domain.py outpath rundate')
+    print(' '.join(SyntheticDomain().write_day(sys.argv[1], sys.argv[2])))
@@ -6,7 +6,7 @@ setup(
     scripts = ['bin/wrfcmaq2inmap',],
     package_data = {'ancillary': ['ancillary/*'],
       'scripts': ['scripts/*']},
-    python_requires='>3.5',
+    python_requires='>=3.7',
     setup_requires=['numpy>=1.12','netCDF4>=1.2.9','pandas'],
     install_requires=['numpy>=1.12','netCDF4>=1.2.9','pandas'],
     author_email='beidler.james@epa.gov'
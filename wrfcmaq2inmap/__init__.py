@@ -2,8 +2,12 @@ __doc__ = r"""
 PYQA
 """
 
-__all__ = ['gridtools','inmap','vardefs']
+__all__ = ['cli','density','extract','fillvalues','gridtools','inmap','ioapi','qastats','validate','vardefs','weights','worker','wrfsource']
 
-import wrfcmaq2inmap.gridtools
-import wrfcmaq2inmap.inmap
-import wrfcmaq2inmap.vardefs
+import importlib
+
+def __getattr__(name):
+    # Submodules are imported on first use so that the command line starts quickly
+    if name in __all__:
+        return importlib.import_module('wrfcmaq2inmap.%s' %name)
+    raise AttributeError("module 'wrfcmaq2inmap' has no attribute '%s'" %name)
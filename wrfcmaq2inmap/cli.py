@@ -0,0 +1,373 @@
+# Command line interface for preprocessing WRF/MCIP/CMAQ output for use in InMap
+# <beidler.james@epa.gov>
+# The heavy modules (netCDF4, pandas, pyproj) are only imported once a day is processed
+#  so that --help and the worker startup are not slowed down by them
+
+import os
+import sys
+import time
+from optparse import OptionParser, OptionGroup
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and argv[0] == 'serve':
+        from wrfcmaq2inmap.worker import serve
+        return serve(argv[1:])
+    if argv and argv[0] == 'validate':
+        from wrfcmaq2inmap.validate import validate
+        return validate(argv[1:])
+    if argv and argv[0] == 'compare-dens':
+        from wrfcmaq2inmap.density import compare
+        return compare(argv[1:])
+    options, args = get_opts(argv)
+    if len(args) != 5:
+        raise ValueError('./gen_wrfcmaq.py wrfout metcro3d cmaq_conc rundate outfile')
+    # Command line options
+    wrf = args[0]       # Path to WRF output file
+    mcip = args[1]      # Path to MCIP METCRO3D file
+    cmaq = args[2]      # Path to CMAQ output concentration file
+    rundate = args[3]   # Current date to process
+    inmap_out = args[4] # Output file name
+    if options.dry_run:
+        # Check the input headers only
+        from wrfcmaq2inmap.validate import run_checks
+        if run_checks([(wrf, mcip, cmaq, rundate, options),]):
+            sys.exit(1)
+        return
+    return run_day(wrf, mcip, cmaq, rundate, inmap_out, options)
+
+def load():
+    '''
+    Import the processing modules. Called once by the worker so that they stay loaded.
+    '''
+    import netCDF4
+    import wrfcmaq2inmap.fillvalues
+    import wrfcmaq2inmap.gridtools
+    import wrfcmaq2inmap.ioapi
+    import wrfcmaq2inmap.inmap
+    import wrfcmaq2inmap.qastats
+    import wrfcmaq2inmap.wrfsource
+
+def scenario_names(cmaq_files, names=''):
+    '''
+    Name each CMAQ scenario from the comma-separated names or from the file names
+    '''
+    if names:
+        names = [name.strip() for name in names.split(',')]
+        if len(names) != len(cmaq_files):
+            raise ValueError('Give one scenario name for each CMAQ file')
+    else:
+        names = [os.path.splitext(os.path.basename(fn))[0] for fn in cmaq_files]
+    if len(set(names)) != len(names):
+        raise ValueError('Scenario names must be unique: %s' %', '.join(names))
+    return names
+
+def run_day(wrf, mcip, cmaq, rundate, inmap_out, options, wrf_cache=None):
+    '''
+    Process a single day of WRF/MCIP/CMAQ output to an InMAP file
+    wrf is one WRF file or a comma-separated list of files, oldest first, that hold the
+    hours of the run date. A WRFCache carries the hours of the newest file to the next day.
+    With --grids one InMAP file is written per output domain, inmap_out and the QA report
+    names take the grid name in place of {grid}. Each input is read once for all domains.
+    cmaq is one CMAQ file or a comma-separated list of scenarios that share the WRF and MCIP.
+    The meteorology is computed once and copied into each scenario output, named with
+    {scenario}, or written once to the --shared-met file.
+    Returns a dictionary of timing and QA metrics for the day
+    '''
+    import numpy as np
+    import netCDF4 as ncf
+    from contextlib import ExitStack
+    from wrfcmaq2inmap.fillvalues import FillPolicy
+    from wrfcmaq2inmap.gridtools import GridDef, GridBounds, QuickLook, Decimation, output_grids
+    from wrfcmaq2inmap.extract import ExtractCache, ExtractWRF
+    from wrfcmaq2inmap.inmap import InMAP, InMAPSet, read_layer_map, vardefs
+    from wrfcmaq2inmap.qastats import QAStats
+    from wrfcmaq2inmap.weights import GridWeights, grid_key, wrf_window
+    from wrfcmaq2inmap.wrfsource import WRFHours
+    metrics = {}
+    start = time.perf_counter()
+    in_grid = GridDef()
+    mcip_grid = GridDef()
+    cmaq_files = cmaq.split(',')
+    scenarios = scenario_names(cmaq_files, options.scenarios)
+    # Read plain ndarrays with an explicit fill value policy instead of masked arrays
+    fill = None
+    if options.unmasked:
+        fill = FillPolicy(options.fill_policy)
+    # Read the windowed inputs through the per-day extract cache
+    extract = None
+    if options.extract_cache:
+        extract = ExtractCache(options.extract_cache, rundate, 'fill-%s' %fill.policy if fill else 'masked')
+    print('Opening %s' %mcip, flush=True)
+    # Output files as (label, path, InMAP) for the QA reports
+    files = []
+    with ExitStack() as stack:
+        mcip = stack.enter_context(ncf.Dataset(mcip))
+        if fill is not None:
+            fill.prepare(mcip)
+        # Define the output grids based on the MCIP or on the listed output domains
+        mcip_grid.io_grid(mcip)
+        out_grids = output_grids(options.grids, options.griddesc, mcip_grid)
+        cmaq_bounds = None
+        if options.grids:
+            cmaq_bounds = [GridBounds(mcip_grid, out_grid) for out_grid in out_grids]
+            for out_grid, bounds in zip(out_grids, cmaq_bounds):
+                if not bounds.inside(mcip_grid):
+                    raise ValueError('Output grid %s is not inside the METCRO3D domain' %out_grid.GDNAM)
+        names = [str(out_grid.GDNAM).strip() for out_grid in out_grids]
+        # A decimated quick-look on the coarser grid with a subset of the hours and layers
+        quicklook = None
+        ntimes = 24
+        nlays = mcip.dimensions['LAY'].size
+        if options.quicklook:
+            if options.static_file:
+                raise ValueError('The static file is not written with --quicklook')
+            layers = range(0, nlays, options.quicklook)
+            if options.quicklook_layers:
+                layers = [int(lay) - 1 for lay in options.quicklook_layers.split(',')]
+            hours = [int(hour) for hour in options.quicklook_hours.split(',')]
+            quicklook = QuickLook(options.quicklook, hours, layers, nlays)
+            ntimes = len(quicklook.hours)
+            nlays = len(quicklook.layers)
+            print('Quick-look of every %s cells, hours %s and layers %s' %(quicklook.stride,
+              ','.join(str(hour) for hour in quicklook.hours),
+              ','.join(str(lay + 1) for lay in quicklook.layers)), flush=True)
+        def out_name(fn, grid, scenario):
+            return fn.replace('{grid}', grid).replace('{scenario}', scenario)
+        # Check that the placeholders keep every output and QA report apart
+        targets = [(inmap_out, name, scenario) for scenario in scenarios for name in names]
+        if options.shared_met:
+            targets += [(options.shared_met, name, 'met') for name in names]
+        paths = [out_name(*target) for target in targets]
+        if len(set(paths)) != len(paths):
+            raise ValueError('Use {grid} and {scenario} in the output file names to keep the outputs apart')
+        reports = [out_name(options.qa_report, name, scenario) for fn, name, scenario in targets]
+        if options.qa_report and len(set(reports)) != len(reports):
+            raise ValueError('Use {grid} and {scenario} in the QA report file name to keep the reports apart')
+        def open_output(fn, label):
+            qa = QAStats(vardefs, options.qa_max_nan, options.qa_max_inf, options.qa_max_range)
+            out_ncf = stack.enter_context(InMAP(fn, 'w', qa))
+            if fill is not None:
+                fill.prepare(out_ncf)
+            # Set the output layer number to the MCIP or the quick-look layers
+            out_ncf.LAYERS = nlays
+            files.append((label, fn, out_ncf))
+            return out_ncf
+        # The outputs of each scenario, one per output grid
+        outputs = {}
+        for scenario in scenarios:
+            outputs[scenario] = [open_output(out_name(inmap_out, name, scenario), (name, scenario))
+              for name in names]
+        if options.shared_met:
+            # The meteorology is written once and each scenario output refers to it
+            met_outputs = [open_output(out_name(options.shared_met, name, 'met'), (name, 'met')) for name in names]
+            for scenario in scenarios:
+                for name, out_ncf in zip(names, outputs[scenario]):
+                    out_ncf.met_file = out_name(options.shared_met, name, 'met')
+        else:
+            # The meteorology is copied into every scenario output
+            met_outputs = [out_ncf for scenario in scenarios for out_ncf in outputs[scenario]]
+        nmet = len(met_outputs) // len(names)
+        # Companion files for the time-invariant fields, written by the first run that needs them
+        static_outputs = None
+        static_files = []
+        # Existing static files and their grid index, checked against the WRF window
+        static_checks = []
+        if options.static_file:
+            if len(names) > 1 and '{grid}' not in options.static_file:
+                raise ValueError('Use {grid} in the static file name for more than one output grid')
+            static_outputs = []
+            for name in names:
+                fn = options.static_file.replace('{grid}', name)
+                if os.path.exists(fn):
+                    static_outputs.append(None)
+                    static_checks.append((fn, len(static_outputs) - 1))
+                    continue
+                # Written under a temporary name so that a failed run does not leave a partial file
+                tmp = '%s.%s.tmp' %(fn, os.getpid())
+                static_ncf = stack.enter_context(InMAP(tmp, 'w'))
+                static_ncf.LAYERS = mcip.dimensions['LAY'].size
+                static_outputs.append(static_ncf)
+                static_files.append((tmp, fn))
+            # Only the first copy of the meteorology writes the static files
+            static_outputs += [None,] * len(names) * (nmet - 1)
+        hours = quicklook and quicklook.hours
+        if extract is None:
+            in_ncf = WRFHours(wrf.split(','), rundate, wrf_cache, fill, hours)
+        else:
+            in_ncf = ExtractWRF(wrf.split(','), rundate, extract, wrf_cache, fill, hours)
+        with in_ncf:
+            in_grid.wrf_grid(in_ncf.newest)
+            # Window the WRF grid, or interpolate it when the projection or cell size differ
+            wrf_bounds = [wrf_window(in_grid, out_grid, options.regrid_method, options.weights_dir)
+              for out_grid in out_grids]
+            if quicklook is not None:
+                # Sample the full-resolution window or interpolation for the coarse grid
+                wrf_bounds = [Decimation(bounds, quicklook, out_grid) for bounds, out_grid in zip(wrf_bounds, out_grids)]
+            if options.static_file:
+                # The grids and layers that the static fields are windowed for
+                if in_ncf.dimensions['bottom_top'].size != mcip.dimensions['LAY'].size:
+                    layer_idx = read_layer_map(options.layers)
+                else:
+                    layer_idx = range(mcip.dimensions['LAY'].size)
+                static_layers = ','.join(str(lay + 1) for lay in layer_idx)
+                static_grids = [grid_key(in_grid, out_grid, options.regrid_method) for out_grid in out_grids]
+                for fn, idx in static_checks:
+                    with ncf.Dataset(fn) as static_ncf:
+                        atts = (getattr(static_ncf, 'static_grids', ''), getattr(static_ncf, 'static_layers', ''))
+                    if atts != (static_grids[idx], static_layers):
+                        raise ValueError('Static file %s was written for another WRF or output grid or layer mapping'
+                          %fn)
+                for static_ncf, key in zip(static_outputs, static_grids):
+                    if static_ncf is not None:
+                        static_ncf.static_grids = key
+                        static_ncf.static_layers = static_layers
+            grid_lists = [(outputs[scenario], ntimes) for scenario in scenarios] + [(static_outputs or [], 1)]
+            if options.shared_met:
+                grid_lists.append((met_outputs, ntimes))
+            for out_list, list_times in grid_lists:
+                for out_ncf, out_grid, bounds in zip(out_list, out_grids, wrf_bounds):
+                    if out_ncf is None:
+                        continue
+                    if quicklook is None:
+                        out_ncf.set_dims(in_ncf, out_grid, list_times)
+                        if isinstance(bounds, GridWeights):
+                            out_ncf.set_proj_atts(out_grid)
+                        continue
+                    out_ncf.set_dims(in_ncf, quicklook.coarse_grid(out_grid), list_times)
+                    out_ncf.set_proj_atts(quicklook.coarse_grid(out_grid))
+                    out_ncf.quicklook_stride = np.int32(quicklook.stride)
+                    out_ncf.quicklook_hours = ','.join(str(hour) for hour in quicklook.hours)
+                    out_ncf.quicklook_layers = ','.join(str(lay + 1) for lay in quicklook.layers)
+            met_set = InMAPSet(met_outputs, wrf_bounds * nmet, cmaq_bounds and cmaq_bounds * nmet,
+              static_outputs, extract, quicklook)
+            # Regrid the WRF input to the CMAQ grid and domains
+            wrf_dens = met_set.regrid(in_ncf, rundate, options.layers, options.alt_source == 'wrf')
+        metrics['regrid_s'] = time.perf_counter() - start
+        if options.alt_source == 'wrf':
+            # The density calculated from the WRF fields read for the regridding
+            dens = wrf_dens
+            desc = 'Inverse density from WRF P, PB, T and QVAPOR'
+        else:
+            # Read the MCIP DENS once, record by record, for the ALT and the gas conversions
+            dens = met_set.local_arrays(met_set.reader(mcip, ['DENS',], fill).read(met_set.tsteps())['DENS'])
+            desc = 'Inverse MCIP DENS'
+        # Insert the ALT variable
+        met_set.append_alt(dens, desc)
+        # The density on each output grid for the gas conversions
+        dens = dens[:len(names)]
+        metrics['alt_s'] = time.perf_counter() - start - metrics['regrid_s']
+        # Only the chemistry is processed for each scenario
+        for scenario, cmaq in zip(scenarios, cmaq_files):
+            print('Opening %s' %cmaq, flush=True)
+            out_set = InMAPSet(outputs[scenario], wrf_bounds, cmaq_bounds, extract=extract, quicklook=quicklook)
+            with ncf.Dataset(cmaq) as cmaq:
+                if fill is not None:
+                    fill.prepare(cmaq)
+                # Append the CMAQ concentrations
+                if options.mech.strip() == '':
+                    # Otherwise append the concentrations
+                    out_set.append_cmaq(cmaq, fill)
+                else:
+                    # If the calculation flag is set, calculate the concentrations
+                    out_set.append_calc_cmaq(cmaq, dens, options.mech, fill)
+        metrics['cmaq_s'] = time.perf_counter() - start - metrics['regrid_s'] - metrics['alt_s']
+        # Record the variables that failed the QA range checks in the global attributes
+        for label, fn, out_ncf in files:
+            out_ncf.qa_problems = ' '.join(out_ncf.qa.problems())
+    for tmp, fn in static_files:
+        os.replace(tmp, fn)
+    metrics['qa_problems'] = []
+    metrics['output_bytes'] = 0
+    for (name, scenario), fn, out_ncf in files:
+        qa = out_ncf.qa
+        if options.qa_report:
+            qa.write_report(out_name(options.qa_report, name, scenario))
+        for varname in qa.problems():
+            if len(files) > 1:
+                varname = '%s:%s' %(os.path.basename(fn), varname)
+            print('WARNING: QA problems found in %s' %varname, flush=True)
+            metrics['qa_problems'].append(varname)
+        metrics['output_bytes'] += os.path.getsize(fn)
+    metrics['total_s'] = time.perf_counter() - start
+    if fill is not None:
+        fill.report()
+        metrics['fill_values'] = fill.counts
+    if extract is not None:
+        metrics['extract_hits'] = extract.hits
+        metrics['extract_misses'] = extract.misses
+    return metrics
+
+def get_parser():
+    '''
+    Define the command line options
+    '''
+    parser = OptionParser(usage = 'usage: %prog [options] wrfout[,wrfout...] metcro3d cmaq_conc[,cmaq_conc...] rundate outfile\n' +\
+      '       %prog serve [--socket path]\n' +\
+      '       %prog validate [options] wrf_template metcro3d_template conc_template start_date end_date\n' +\
+      '       %prog compare-dens [options] wrfout[,wrfout...] metcro3d rundate')
+    parser.add_option('-l', '--layers', dest='layers', default='',
+      help='Path to the layers mapping file for converting between layering schemes')
+    parser.add_option('-m', '--mech', dest='mech', default='cb6',
+      help='Chemical mechanism to apply (cb6 or saprc). Leave blank if partioning fractions are precalculatd.')
+    parser.add_option('-n', '--dry-run', dest='dry_run', action='store_true', default=False,
+      help='Only check the input file headers for the day and report any problems')
+    parser.add_option('--unmasked', dest='unmasked', action='store_true', default=False,
+      help='Read plain arrays with the auto-masking and scaling turned off (faster). Fill values are ' +\
+      'handled by the fill policy.')
+    parser.add_option('--fill-policy', dest='fill_policy', default='nan', choices=['nan','zero','error','keep'],
+      help='Fill values found in unmasked reads are replaced with nan or zero, raise an error or are kept [default: %default]')
+    parser.add_option('-g', '--grids', dest='grids', default='',
+      help='Comma-separated output domains inside the METCRO3D domain, as IOAPI file paths or as grid ' +\
+      'names in the --griddesc file. Use {grid} in the outfile name for the grid name.')
+    parser.add_option('--griddesc', dest='griddesc', default='',
+      help='Path to the GRIDDESC file for the --grids names')
+    parser.add_option('--scenarios', dest='scenarios', default='',
+      help='Comma-separated names of the CMAQ scenarios given as cmaq_conc[,cmaq_conc...], used for ' +\
+      '{scenario} in the outfile name. The CMAQ file names by default.')
+    parser.add_option('--shared-met', dest='shared_met', default='',
+      help='Write the WRF/ALT meteorology once to this file and only the chemistry to each scenario ' +\
+      'output, which names it in the met_file attribute. Copied into each scenario output by default.')
+    parser.add_option('--static-file', dest='static_file', default='',
+      help='Write the time-invariant WRF fields (PHB, PB, LU_INDEX) once to this companion file, ' +\
+      'with one time step, instead of repeating them in every hour of each output. Use {grid} for the grid name.')
+    parser.add_option('--extract-cache', dest='extract_cache', default='',
+      help='Directory on local disk to keep the windowed WRF, METCRO3D and CMAQ arrays in. Later runs ' +\
+      'of the same day read them from there while the input files are unchanged.')
+    parser.add_option('--alt-source', dest='alt_source', default='mcip', choices=['mcip','wrf'],
+      help='Take the ALT and the density for the gas conversions from the METCRO3D DENS or calculate ' +\
+      'them from the WRF P, PB, T and QVAPOR. With wrf the METCRO3D argument only sets the output grid ' +\
+      'and layers and can be the CCTM_CONC file. [default: %default]')
+    parser.add_option('--regrid-method', dest='regrid_method', default='bilinear', choices=['bilinear','area'],
+      help='Interpolation for a WRF grid in another projection or cell size than the output [default: %default]')
+    parser.add_option('--weights-dir', dest='weights_dir',
+      default=os.path.join(os.path.expanduser('~'), '.cache', 'wrfcmaq2inmap'),
+      help='Directory to cache the interpolation weights in, blank to not cache [default: %default]')
+    group = OptionGroup(parser, 'Quick-look',
+      'A fast decimated output on a coarser grid for checking a run before the full processing')
+    group.add_option('--quicklook', dest='quicklook', type='int', default=0,
+      help='Write every N-th cell in each direction on a grid with N times the cell size')
+    group.add_option('--quicklook-hours', dest='quicklook_hours', default='0,6,12,18',
+      help='Comma-separated hours of the run date to write [default: %default]')
+    group.add_option('--quicklook-layers', dest='quicklook_layers', default='',
+      help='Comma-separated output layers to write, starting at 1. Every N-th layer by default.')
+    parser.add_option_group(group)
+    group = OptionGroup(parser, 'QA statistics',
+      'Statistics are collected for every variable while it is written and stored as qa_* attributes')
+    group.add_option('--qa-report', dest='qa_report', default='',
+      help='Path to write the per-variable QA summary report (CSV)')
+    group.add_option('--qa-max-nan', dest='qa_max_nan', type='int', default=None,
+      help='Fail as soon as any variable has more than this many NaN values, counting masked values as NaN')
+    group.add_option('--qa-max-inf', dest='qa_max_inf', type='int', default=None,
+      help='Fail as soon as any variable has more than this many inf values')
+    group.add_option('--qa-max-range', dest='qa_max_range', type='int', default=None,
+      help='Fail as soon as any variable has more than this many out-of-range values')
+    parser.add_option_group(group)
+    return parser
+
+def get_opts(argv=None):
+    '''
+    Read in the command line options
+    '''
+    return get_parser().parse_args(argv)
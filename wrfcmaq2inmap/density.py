@@ -0,0 +1,103 @@
+# Air density from the WRF pressure, potential temperature and moisture
+#
+# The ALT (inverse density) is normally taken from the MCIP METCRO3D DENS. P, PB and T are
+#  already read for the regridding, so with --alt-source wrf only QVAPOR is read in addition
+#  and the density is calculated from the windowed and layer-mapped WRF arrays instead of
+#  reading the METCRO3D DENS. compare-dens reports how far this is from the MCIP DENS.
+
+import sys
+import numpy as np
+from optparse import OptionParser
+
+# WRF constants (share/module_model_constants.F)
+R_D = 287.
+R_V = 461.6
+CP = 7. * R_D / 2.
+P1000MB = 100000.
+T0 = 300.
+
+def wrf_dens(p, pb, t, qvapor):
+    '''
+    Moist air density (kg m-3) from the WRF perturbation and base state pressures (Pa), the
+    perturbation potential temperature (K) and the water vapor mixing ratio (kg kg-1)
+    The arrays only need to broadcast, ie. a time-invariant PB with one time step
+    '''
+    pres = np.add(p, pb, dtype=np.float64)
+    temp = (t + T0) * (pres / P1000MB) ** (R_D / CP)
+    # Virtual temperature from the mixing ratio
+    tv = temp * (1. + qvapor * (R_V / R_D)) / (1. + qvapor)
+    return pres / (R_D * tv)
+
+def compare_dens(wrf, mcip, rundate, layers_fn='', method='bilinear', weights_dir=''):
+    '''
+    Compare the density calculated from the WRF on the METCRO3D grid with the MCIP DENS for
+    the 24 hours of the run date
+    Returns a DataFrame of the differences by layer and over all layers
+    '''
+    import netCDF4 as ncf
+    import pandas as pd
+    from wrfcmaq2inmap.gridtools import GridDef
+    from wrfcmaq2inmap.inmap import read_layer_map
+    from wrfcmaq2inmap.ioapi import RecordReader
+    from wrfcmaq2inmap.vardefs import VarDefs
+    from wrfcmaq2inmap.weights import wrf_window
+    from wrfcmaq2inmap.wrfsource import WRFHours
+    vardefs = VarDefs()
+    in_grid = GridDef()
+    mcip_grid = GridDef()
+    with ncf.Dataset(mcip) as mcip_ncf:
+        mcip_grid.io_grid(mcip_ncf)
+        lays = mcip_ncf.dimensions['LAY'].size
+        mcip_dens = RecordReader(mcip_ncf, ['DENS',]).read(24)['DENS']
+    with WRFHours(wrf.split(','), rundate) as in_ncf:
+        in_grid.wrf_grid(in_ncf.newest)
+        missing = [varname for varname in vardefs.dens_vars if varname not in in_ncf.variables]
+        if missing:
+            raise ValueError('Missing %s in WRF' %', '.join(missing))
+        bounds = wrf_window(in_grid, mcip_grid, method, weights_dir)
+        if in_ncf.dimensions['bottom_top'].size != lays:
+            layer_idx = read_layer_map(layers_fn)
+        else:
+            layer_idx = list(range(lays))
+        in_ncf.locate(vardefs.dens_vars)
+        row_slice = slice(bounds.irow_o, bounds.irow_o + bounds.orow_e)
+        col_slice = slice(bounds.icol_o, bounds.icol_o + bounds.ocol_e)
+        arrs = dict((varname, in_ncf.read(varname, layer_idx, row_slice, col_slice))
+          for varname in vardefs.dens_vars)
+    dens = wrf_dens(*[arrs[varname] for varname in vardefs.dens_vars])
+    if hasattr(bounds, 'apply'):
+        dens = bounds.apply(dens)
+    diff = dens - mcip_dens
+    rel = diff / mcip_dens
+    rows = []
+    for lay in list(range(lays)) + [None,]:
+        idx = slice(None) if lay is None else lay
+        rows.append({'layer': 'all' if lay is None else lay + 1,
+          'mcip_mean': float(np.ma.mean(mcip_dens[:,idx])), 'wrf_mean': float(np.ma.mean(dens[:,idx])),
+          'mean_diff': float(np.ma.mean(diff[:,idx])), 'max_abs_diff': float(np.ma.max(abs(diff[:,idx]))),
+          'mean_abs_rel_diff': float(np.ma.mean(abs(rel[:,idx]))), 'max_abs_rel_diff': float(np.ma.max(abs(rel[:,idx])))})
+    return pd.DataFrame(rows)
+
+def compare(argv=None):
+    '''
+    Command line entry for compare-dens
+    '''
+    parser = OptionParser(usage='usage: %prog compare-dens [options] wrfout[,wrfout...] metcro3d rundate')
+    parser.add_option('-l', '--layers', dest='layers', default='',
+      help='Path to the layers mapping file for converting between layering schemes')
+    parser.add_option('--regrid-method', dest='regrid_method', default='bilinear', choices=['bilinear','area'],
+      help='Interpolation for a WRF grid in another projection or cell size than the METCRO3D [default: %default]')
+    parser.add_option('--weights-dir', dest='weights_dir', default='',
+      help='Directory the interpolation weights are cached in')
+    parser.add_option('--report', dest='report', default='',
+      help='Path to write the differences by layer (CSV)')
+    options, args = parser.parse_args(argv)
+    if len(args) != 3:
+        parser.error('wrfout metcro3d rundate are needed')
+    df = compare_dens(args[0], args[1], args[2], options.layers, options.regrid_method, options.weights_dir)
+    if options.report:
+        df.to_csv(options.report, index=False)
+    print(df.to_string(index=False, float_format=lambda x: '%.6g' %x))
+
+if __name__ == '__main__':
+    sys.exit(compare())
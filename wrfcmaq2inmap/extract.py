@@ -0,0 +1,232 @@
+# Columnar extract cache of the windowed WRF and CMAQ inputs
+#
+# The wrfout and CCTM_CONC files hold hundreds of variables that are never used. With an
+#  extract cache the arrays that a run reads, already windowed and layer-mapped, are kept as
+#  per-day .npy files on local disk and read back memory-mapped by later runs. The CMAQ
+#  extract holds the species of every mechanism, so reruns with another mechanism or other
+#  partitions only read the cache. Each array is valid while the size and modification time
+#  of its source files are unchanged. File headers are still read from the sources.
+
+import hashlib
+import json
+import os
+import numpy as np
+from wrfcmaq2inmap.ioapi import RecordReader, tstep_list
+from wrfcmaq2inmap.wrfsource import WRFHours
+
+class ExtractCache:
+    """
+    Windowed input arrays for one day stored as .npy files with a manifest of their sources
+    """
+    def __init__(self, cache_dir, rundate, mode='masked'):
+        self.path = os.path.join(cache_dir, str(rundate))
+        os.makedirs(self.path, exist_ok=True)
+        # The read mode (masked or the fill policy) is part of every array name
+        self.mode = mode
+        self.manifest_fn = os.path.join(self.path, 'manifest.json')
+        self.manifest = {}
+        if os.path.exists(self.manifest_fn):
+            with open(self.manifest_fn) as f:
+                self.manifest = json.load(f)
+        self.hits = 0
+        self.misses = 0
+
+    def name(self, varname, sources, key):
+        '''
+        Array name from the variable, the source files, the window key and the read mode
+        '''
+        desc = repr(([os.path.abspath(src) for src in sources], key, self.mode))
+        return '%s_%s' %(varname, hashlib.sha1(desc.encode()).hexdigest()[:12])
+
+    def _signature(self, sources):
+        sig = []
+        for src in sources:
+            st = os.stat(src)
+            sig.append([os.path.abspath(src), st.st_size, st.st_mtime_ns])
+        return sig
+
+    def _fn(self, name, suffix=''):
+        return os.path.join(self.path, '%s%s.npy' %(name, suffix))
+
+    def valid(self, name, sources, nsteps=None):
+        '''
+        Check that an array is stored, is not shorter than nsteps and its sources are unchanged
+        '''
+        entry = self.manifest.get(name)
+        if entry is None or not os.path.exists(self._fn(name)):
+            return False
+        if nsteps is not None and entry['nsteps'] < nsteps:
+            return False
+        if entry['sources'] != self._signature(sources):
+            return False
+        self.hits += 1
+        return True
+
+    def load(self, name):
+        '''
+        Read a stored array memory-mapped
+        '''
+        arr = np.load(self._fn(name), mmap_mode='r')
+        if self.manifest[name]['masked']:
+            arr = np.ma.masked_array(arr, np.load(self._fn(name, '_mask'), mmap_mode='r'))
+        return arr
+
+    def create(self, name, dtype, shape, suffix=''):
+        '''
+        Start a new array, or with the _mask suffix its mask, as a writable memory map under a
+        temporary name
+        '''
+        if not suffix:
+            self.misses += 1
+        return np.lib.format.open_memmap(self._fn(name, '%s.%s.tmp' %(suffix, os.getpid())), 'w+', dtype, shape)
+
+    def commit(self, name, sources, arr, mask=None):
+        '''
+        Move a completed array, written with create, into place and record its sources
+        The mask may be an array or a memory map written with create
+        '''
+        arr.flush()
+        masked = mask is not None
+        if isinstance(mask, np.memmap):
+            mask.flush()
+            os.replace(mask.filename, self._fn(name, '_mask'))
+        elif masked:
+            np.save(self._fn(name, '_mask'), mask)
+        os.replace(arr.filename, self._fn(name))
+        self.manifest[name] = {'sources': self._signature(sources), 'nsteps': int(arr.shape[0]),
+          'masked': masked}
+        # Other processes may have added their own arrays for the day
+        manifest = {}
+        if os.path.exists(self.manifest_fn):
+            with open(self.manifest_fn) as f:
+                manifest = json.load(f)
+        manifest.update(self.manifest)
+        self.manifest = manifest
+        tmp = '%s.%s.tmp' %(self.manifest_fn, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp, self.manifest_fn)
+
+    def save(self, name, sources, arr):
+        '''
+        Store a whole array, with its mask if any values are masked
+        '''
+        out = self.create(name, np.ma.getdata(arr).dtype, arr.shape)
+        out[:] = np.ma.getdata(arr)
+        mask = None
+        if np.ma.is_masked(arr):
+            mask = np.ma.getmaskarray(arr)
+        self.commit(name, sources, out, mask)
+
+class ExtractWRF(WRFHours):
+    """
+    WRFHours that reads the windowed, layer-mapped variables from an ExtractCache when they are
+    stored and stores them when they are not
+    The WRF records are only located when a variable has to be read from the files.
+    """
+    def __init__(self, wrf_files, rundate, extract, cache=None, fill=None, hours=None):
+        WRFHours.__init__(self, wrf_files, rundate, cache, fill, hours)
+        self.extract = extract
+        self._key = None
+        self._locate = None
+
+    def _sources(self):
+        return [self._path(idx) for idx in range(len(self.files))]
+
+    def set_key(self, key):
+        self._key = key
+        WRFHours.set_key(self, key)
+
+    def locate(self, varnames, key=None):
+        # Deferred until a variable is not in the extract
+        self._locate = (varnames, key)
+
+    def read_static(self, varname, lay_slice, row_slice, col_slice):
+        name = self.extract.name('static_' + varname, self._sources(), self._key)
+        if self.extract.valid(name, self._sources()):
+            return self.extract.load(name)
+        arr = WRFHours.read_static(self, varname, lay_slice, row_slice, col_slice)
+        if arr is not None:
+            self.extract.save(name, self._sources(), arr)
+        return arr
+
+    def read(self, varname, lay_slice, row_slice, col_slice):
+        name = self.extract.name(varname, self._sources(), (self._key, tuple(self.hours)))
+        if self.extract.valid(name, self._sources(), len(self.hours)):
+            return self.extract.load(name)
+        if self._locate is not None:
+            WRFHours.locate(self, *self._locate)
+            self._locate = None
+        arr = WRFHours.read(self, varname, lay_slice, row_slice, col_slice)
+        self.extract.save(name, self._sources(), arr)
+        return arr
+
+class ExtractReader:
+    """
+    RecordReader over an ExtractCache
+    When any of the variables is not stored, the variables and the prefetch variables found in
+    the file are read record by record and stored.
+    """
+    def __init__(self, extract, ncf, varnames, fill=None, window=None, prefetch=(), layers=None):
+        self.extract = extract
+        self.ncf = ncf
+        self.fill = fill
+        self.window = window
+        self.layers = layers
+        self.prefetch = list(prefetch)
+        reader = RecordReader(ncf, varnames, fill, window, layers)
+        self.varnames = reader.varnames
+        self.missing = reader.missing
+        self.sources = [ncf.filepath(),]
+
+    def _name(self, varname):
+        window = self.window
+        if window is not None:
+            window = tuple((s.start, s.stop, s.step) for s in window)
+        layers = self.layers
+        if layers is not None:
+            layers = tuple(layers)
+        return self.extract.name(varname, self.sources, (window, layers))
+
+    def _extract(self, nsteps):
+        '''
+        Read the variables and the prefetch variables from the file into the extract
+        '''
+        reader = RecordReader(self.ncf, self.varnames + self.prefetch, self.fill, self.window, self.layers)
+        print('Extracting %s variables from %s' %(len(reader.varnames), self.sources[0]), flush=True)
+        arrs = {}
+        # Masks are only started, as memory maps, when a record first has masked values
+        masks = {}
+        for tstep, bufs in reader.records(nsteps):
+            if not arrs:
+                arrs = dict((varname, self.extract.create(self._name(varname), buf.dtype, (nsteps,) + buf.shape))
+                  for varname, buf in bufs.items())
+            for varname, buf in bufs.items():
+                arrs[varname][tstep] = np.ma.getdata(buf)
+                if varname not in masks and np.ma.is_masked(buf):
+                    masks[varname] = self.extract.create(self._name(varname), bool, arrs[varname].shape, '_mask')
+                if varname in masks:
+                    masks[varname][tstep] = np.ma.getmaskarray(buf)
+        for varname, arr in arrs.items():
+            self.extract.commit(self._name(varname), self.sources, arr, masks.get(varname))
+
+    def read(self, nsteps=24):
+        '''
+        The first nsteps records, or the listed records, of every variable
+        The extract always holds the records from the start of the file
+        '''
+        tsteps = tstep_list(nsteps)
+        nrecs = max(tsteps) + 1
+        if not all(self.extract.valid(self._name(varname), self.sources, nrecs) for varname in self.varnames):
+            self._extract(nrecs)
+        if isinstance(nsteps, int):
+            return dict((varname, self.extract.load(self._name(varname))[:nsteps]) for varname in self.varnames)
+        return dict((varname, self.extract.load(self._name(varname))[tsteps]) for varname in self.varnames)
+
+    def records(self, nsteps=24):
+        '''
+        Yield the time step index and a dictionary of the variables for that record
+        '''
+        arrs = self.read(nsteps)
+        for idx in range(len(tstep_list(nsteps))):
+            yield idx, dict((varname, arr[idx]) for varname, arr in arrs.items())
@@ -0,0 +1,92 @@
+# Explicit fill value handling for reads with the netCDF4 auto-masking turned off
+#
+# By default every netCDF4 read returns a numpy masked array and all of the arithmetic runs
+#  through MaskedArray, which is several times slower and allocates the mask arrays. With a
+#  FillPolicy the datasets return plain ndarrays and the fill values are found, replaced
+#  and counted here instead.
+
+import numpy as np
+import netCDF4 as ncf
+
+class FillPolicy:
+    """
+    Find, replace and count the fill values in plain ndarray reads
+    nan: replace with NaN, zero: replace with 0, error: raise a ValueError, keep: leave as is
+    """
+    policies = ('nan','zero','error','keep')
+
+    def __init__(self, policy='nan'):
+        if policy not in self.policies:
+            raise ValueError('Unknown fill value policy %s' %policy)
+        self.policy = policy
+        self.counts = {}
+        self._fills = {}
+
+    def prepare(self, ds):
+        '''
+        Turn off the auto-masking and scaling on a dataset
+        '''
+        ds.set_auto_maskandscale(False)
+        return ds
+
+    def fill_values(self, var):
+        '''
+        The values that mark missing data for a variable, as netCDF4 would mask them
+        '''
+        key = (var.group().filepath(), var.name)
+        if key not in self._fills:
+            atts = var.ncattrs()
+            fills = []
+            for att in ('_FillValue','missing_value'):
+                if att in atts:
+                    fills.extend(np.atleast_1d(var.getncattr(att)).tolist())
+            if '_FillValue' not in atts and var.dtype.str[1:] in ncf.default_fillvals:
+                fills.append(ncf.default_fillvals[var.dtype.str[1:]])
+            self._fills[key] = np.array(fills, var.dtype)
+        return self._fills[key]
+
+    def dtype(self, var):
+        '''
+        The type of the arrays returned by apply for a variable
+        '''
+        atts = var.ncattrs()
+        if 'scale_factor' in atts or 'add_offset' in atts or \
+          (self.policy == 'nan' and not np.issubdtype(var.dtype, np.floating)):
+            return np.result_type(var.dtype, np.float32)
+        return var.dtype
+
+    def apply(self, var, arr):
+        '''
+        Apply the policy to an array read from var, in place where possible
+        Packed variables are unpacked here as the auto-scaling is off.
+        '''
+        fills = self.fill_values(var)
+        hits = None
+        for fill in fills:
+            hit = arr == fill
+            hits = hit if hits is None else hits | hit
+        nfill = 0 if hits is None else int(hits.sum())
+        atts = var.ncattrs()
+        if 'scale_factor' in atts or 'add_offset' in atts:
+            arr = arr * var.getncattr('scale_factor') if 'scale_factor' in atts else arr.astype(np.float32)
+            if 'add_offset' in atts:
+                arr = arr + var.getncattr('add_offset')
+        if not nfill:
+            return arr
+        self.counts[var.name] = self.counts.get(var.name, 0) + nfill
+        if self.policy == 'error':
+            raise ValueError('Found %s fill values in %s' %(nfill, var.name))
+        elif self.policy == 'nan':
+            if not np.issubdtype(arr.dtype, np.floating):
+                arr = arr.astype(np.float32)
+            arr[hits] = np.nan
+        elif self.policy == 'zero':
+            arr[hits] = 0
+        return arr
+
+    def report(self):
+        '''
+        Print the number of fill values found in each variable
+        '''
+        for varname, count in self.counts.items():
+            print('WARNING: %s fill values in %s (policy %s)' %(count, varname, self.policy), flush=True)
@@ -1,7 +1,44 @@
 # Library containing routines to define gridded modeling domains and calculate boundaries/offsets
 
+import os
+from functools import lru_cache
+import numpy as np
 from pyproj import Proj
 
+@lru_cache()
+def get_proj(proj4):
+    '''
+    Initialize a projection once per proj4 string
+    '''
+    return Proj(proj4)
+
+def _stag_mean(arr, axis):
+    '''
+    Mean of each pair of neighboring points along the row (-2) or col (-1) axis
+    '''
+    arr = np.moveaxis(arr, axis, -1)
+    return np.moveaxis(0.5 * (arr[...,:-1] + arr[...,1:]), -1, axis)
+
+def _pad_edges(arr, axis):
+    '''
+    Repeat the first and last points along the row (-2) or col (-1) axis
+    '''
+    arr = np.moveaxis(arr, axis, -1)
+    concat = np.ma.concatenate if np.ma.isMaskedArray(arr) else np.concatenate
+    return np.moveaxis(concat([arr[...,:1], arr, arr[...,-1:]], axis=-1), -1, axis)
+
+def rotate_winds(u, v, angles):
+    '''
+    Rotate the grid-relative U (west_east_stag) and V (south_north_stag) counterclockwise by the
+    angles (radians) at the col and row points
+    The other component at each staggered point is averaged from the mass points around it
+    '''
+    v_col = _stag_mean(_pad_edges(_stag_mean(v, -2), -1), -1)
+    u_row = _stag_mean(_pad_edges(_stag_mean(u, -1), -2), -2)
+    cos_col, sin_col = np.cos(angles['col']), np.sin(angles['col'])
+    cos_row, sin_row = np.cos(angles['row']), np.sin(angles['row'])
+    return u * cos_col - v_col * sin_col, u_row * sin_row + v * cos_row
+
 class GridDef:
     """
     Define the gridded modeling domains from a wrf or ioapi file
@@ -27,7 +64,7 @@ class GridDef:
             self.GDTYP = 2
         else:
             self.GDTYP = int(ncf.MAP_PROJ)
-        proj = Proj(self.proj4())
+        proj = get_proj(self.proj4())
         # XLONG and XLAT are at the centroids
         lon = float(ncf.variables['XLONG'][0,0,0])
         lat = float(ncf.variables['XLAT'][0,0,0])
@@ -44,16 +81,63 @@ class GridDef:
         for att in self.grid_atts:
             setattr(self, att, getattr(ncf, att))
 
+    def desc_grid(self, grid_name, grid_desc):
+        '''
+        Define a grid from a named grid in a GRIDDESC file
+        Follows the parsing in ancillary/fauxioapi.Grid, with comma or space separated values
+        '''
+        def split_line(line):
+            return [cell.strip("'") for cell in line.split('!')[0].replace(',', ' ').split()]
+        def parse_float(x):
+            return float(x.replace('D','E'))
+        with open(grid_desc) as gd:
+            state = 'start'
+            proj_table = dict()
+            for line in gd:
+                if not line.split('!')[0].strip():
+                    continue
+                # Names are quoted and may be followed by a comma
+                name = ''.join(split_line(line)[:1])
+                # Blank names start the file and end the projection and the grid sections
+                if name == '':
+                    if state == 'grid':
+                        break
+                    state = 'proj' if state == 'start' else 'grid'
+                    continue
+                if state == 'start':
+                    state = 'proj'
+                s_line = split_line(next(gd))
+                if state == 'proj':
+                    proj_table[name] = {'GDTYP': int(s_line[0]),
+                        'P_ALP': parse_float(s_line[1]),
+                        'P_BET': parse_float(s_line[2]),
+                        'P_GAM': parse_float(s_line[3]),
+                        'XCENT': parse_float(s_line[4]),
+                        'YCENT': parse_float(s_line[5])}
+                elif name == grid_name:
+                    self.XORIG, self.YORIG, self.XCELL, self.YCELL = [parse_float(x) for x in s_line[1:5]]
+                    self.NCOLS, self.NROWS, self.NTHIK = [int(x) for x in s_line[5:8]]
+                    for k, v in proj_table[s_line[0]].items():
+                        setattr(self, k, v)
+                    self.GDNAM = grid_name
+                    return
+        raise ValueError('Grid %s not found in grid description file %s' %(grid_name, grid_desc))
+
+    def same_proj(self, grid2):
+        '''
+        Check that this grid has the same projection as another
+        '''
+        return all(getattr(self, projatt) == getattr(grid2, projatt)
+          for projatt in ['GDTYP','P_ALP','P_BET','P_GAM','XCENT','YCENT'])
+
     def check_grids(self, grid2):
         '''
         Compare the projection and cell size for this grid to another
         Raises a fatal value error for mismatches
         '''
         err = ''
-        for projatt in ['GDTYP','P_ALP','P_BET','P_GAM','XCENT','YCENT']:
-            if getattr(self, projatt) != getattr(grid2, projatt):
-                err = 'Projection mismatch between the WRF input domain and the output domain'
-                break
+        if not self.same_proj(grid2):
+            err = 'Projection mismatch between the WRF input domain and the output domain'
         if self.XCELL != grid2.XCELL or self.YCELL != grid2.YCELL:
             err = 'Grid cell size mismatch'
         if err:
@@ -111,7 +195,7 @@ class GridBounds:
         y_dist = out_y_end - in_y_end
         if x_dist > 0: # If the endpoint of the old is inside the new
             self.icol_e = in_grid.NCOLS
-            self.ocol_e = int(out_grid.NCOLS - abs(x_dist/out_grid.cell)) # Calculate the last out_grid cell to aggregate
+            self.ocol_e = int(out_grid.NCOLS - abs(x_dist/out_grid.XCELL)) # Calculate the last out_grid cell to aggregate
             if self.ocol_e > int(self.ocol_e): # Check to see if there is anything after the decimal ie. a partial column calculated.
                 self.ocol_e = int(self.ocol_e) + 1  # If there is a partial column then add a column to be processed to hold the extra input data
         else:
@@ -127,3 +211,139 @@ class GridBounds:
             self.orow_e = out_grid.NROWS
         self.chunk_dim = float(out_grid.XCELL)/float(in_grid.XCELL)  # How many times larger is the output cell versus the input
 
+    def inside(self, in_grid):
+        '''
+        Check that the whole output domain is a window of the input grid
+        '''
+        return not (self.ocol_o or self.out_row_orig or self.irow_o + self.orow_e > in_grid.NROWS or \
+          self.icol_o + self.ocol_e > in_grid.NCOLS)
+
+
+def output_grids(grids, grid_desc='', default=None):
+    '''
+    Define the output domains from a comma-separated list of IOAPI (ie. MCIP) file paths or
+    of grid names in the grid_desc GRIDDESC file
+    Returns a list of GridDef, or [default,] when no grids are listed
+    '''
+    import netCDF4 as ncf
+    out_grids = []
+    for grid in [grid.strip() for grid in grids.split(',') if grid.strip()]:
+        out_grid = GridDef()
+        if os.path.exists(grid):
+            with ncf.Dataset(grid) as ds:
+                out_grid.io_grid(ds)
+            out_grid.GDNAM = str(out_grid.GDNAM).strip()
+        elif grid_desc:
+            out_grid.desc_grid(grid, grid_desc)
+        else:
+            raise ValueError('Grid %s is not a file and no GRIDDESC file is set' %grid)
+        out_grids.append(out_grid)
+    if not out_grids:
+        return [default,]
+    names = [out_grid.GDNAM for out_grid in out_grids]
+    if len(set(names)) != len(names):
+        raise ValueError('Output grid names must be unique: %s' %', '.join(names))
+    return out_grids
+
+class UnionBounds:
+    '''
+    The input window covering the input windows of several GridBounds
+    Used to read an input once for several output domains
+    '''
+    def __init__(self, bounds_list):
+        self.irow_o = min(bounds.irow_o for bounds in bounds_list)
+        self.icol_o = min(bounds.icol_o for bounds in bounds_list)
+        self.orow_e = max(bounds.irow_o + bounds.orow_e for bounds in bounds_list) - self.irow_o
+        self.ocol_e = max(bounds.icol_o + bounds.ocol_e for bounds in bounds_list) - self.icol_o
+
+    def window(self):
+        '''
+        Row and column slices of the union window in the input grid
+        '''
+        return (slice(self.irow_o, self.irow_o + self.orow_e), slice(self.icol_o, self.icol_o + self.ocol_e))
+
+    def local_slice(self, bounds, col_stag=False, row_stag=False):
+        '''
+        Row and column slices of one bounds window within the union window
+        '''
+        row_o = bounds.irow_o - self.irow_o
+        col_o = bounds.icol_o - self.icol_o
+        return (slice(row_o, row_o + bounds.orow_e + int(row_stag)),
+          slice(col_o, col_o + bounds.ocol_e + int(col_stag)))
+
+class QuickLook:
+    '''
+    A decimated quick-look run: every stride-th cell in each direction on a grid with stride
+    times the cell size, a subset of the hours and a subset of the output layers
+    '''
+    def __init__(self, stride, hours, layers, nlays):
+        self.stride = int(stride)
+        self.hours = list(hours)
+        self.layers = list(layers)
+        # Number of layers in the full output
+        self.nlays = nlays
+        if self.stride < 1:
+            raise ValueError('The quick-look stride must be at least 1')
+        if not self.hours or min(self.hours) < 0 or max(self.hours) > 23:
+            raise ValueError('The quick-look hours must be between 0 and 23')
+        if not self.layers or min(self.layers) < 0 or max(self.layers) >= nlays:
+            raise ValueError('The quick-look layers must be between 0 and %s' %(nlays - 1))
+
+    def coarse_grid(self, grid):
+        '''
+        The coarser output grid with the same origin
+        '''
+        coarse = GridDef()
+        for att in coarse.grid_atts:
+            setattr(coarse, att, getattr(grid, att))
+        coarse.XCELL = grid.XCELL * self.stride
+        coarse.YCELL = grid.YCELL * self.stride
+        coarse.NCOLS = int(grid.NCOLS) // self.stride
+        coarse.NROWS = int(grid.NROWS) // self.stride
+        return coarse
+
+    def sample(self, start, ncells, stag=False):
+        '''
+        Strided slice from a fine window start for ncells coarse cells
+        Cells take the middle fine cell of their block and staggered points every stride-th edge
+        '''
+        start = start or 0
+        if stag:
+            return slice(start, start + ncells * self.stride + 1, self.stride)
+        first = start + self.stride // 2
+        return slice(first, first + (ncells - 1) * self.stride + 1, self.stride)
+
+class Decimation:
+    '''
+    Strided sampling of the full-resolution output of a GridBounds or GridWeights for the
+    QuickLook coarse grid of out_grid
+    The input window that is read is the one of the wrapped bounds
+    '''
+    def __init__(self, bounds, quicklook, out_grid):
+        self.bounds = bounds
+        self.quicklook = quicklook
+        self.rotate_winds = getattr(bounds, 'rotate_winds', False)
+        self.irow_o = bounds.irow_o
+        self.icol_o = bounds.icol_o
+        self.orow_e = bounds.orow_e
+        self.ocol_e = bounds.ocol_e
+        self.nrows = int(out_grid.NROWS) // quicklook.stride
+        self.ncols = int(out_grid.NCOLS) // quicklook.stride
+
+    def apply(self, arr, row_stag=False, col_stag=False, nearest=False, sampled=False):
+        '''
+        Sample an array windowed to the bounds window, with rows and cols last
+        With sampled the array is already on the full-resolution output grid
+        '''
+        if hasattr(self.bounds, 'apply') and not sampled:
+            arr = self.bounds.apply(arr, row_stag, col_stag, nearest)
+        rows = self.quicklook.sample(0, self.nrows, row_stag)
+        cols = self.quicklook.sample(0, self.ncols, col_stag)
+        return arr[...,rows,cols]
+
+    def rotate(self, u, v):
+        '''
+        Interpolate and rotate the winds at full resolution with the wrapped bounds and sample them
+        '''
+        u, v = self.bounds.rotate(u, v)
+        return self.apply(u, col_stag=True, sampled=True), self.apply(v, row_stag=True, sampled=True)
@@ -3,64 +3,70 @@ import netCDF4 as ncf
 import pandas as pd
 from wrfcmaq2inmap.vardefs import * 
 from wrfcmaq2inmap.gridtools import * 
+from wrfcmaq2inmap.density import wrf_dens
+from wrfcmaq2inmap.extract import ExtractReader
+from wrfcmaq2inmap.ioapi import RecordReader
+from wrfcmaq2inmap.wrfsource import WRFHours, wrf_dates
 
 vardefs = VarDefs()
+# Layer mappings by file name, kept for workers that process several days
+layer_maps = {}
+
+def read_layer_map(fn):
+    '''
+    Read the zero-based input layer index for each output layer from a layer mapping file
+    Where lay1 is the layer set you map from and lay2 is the target layer set
+    '''
+    if fn not in layer_maps:
+        df = pd.read_csv(fn, usecols=['lay1','lay2'])
+        layer_maps[fn] = [x-1 for x in df['lay1'].values]
+    return layer_maps[fn]
 
 # Variables to read from the WRF outputs
 class InMAP(ncf.Dataset):
     """
     NCF subclass with functions for processing to the InMAP file
     """
-    def __init__(self, file_name, mode='r'):
+    def __init__(self, file_name, mode='r', qa=None):
         print('Opening %s' %file_name, flush=True)
         ncf.Dataset.__init__(self, file_name, mode, format='NETCDF4_CLASSIC') #format='NETCDF3_64BIT')
         self.LAYERS = 0
+        # Python-only attribute, kept out of the netCDF global attributes
+        self.__dict__['qa'] = qa
+
+    def _write(self, var_out, arr, idx=slice(None)):
+        '''
+        Write a block of values to an output variable and update the QA statistics
+        The statistics are for the values as stored, after the cast to the output type
+        '''
+        with np.errstate(over='ignore'):
+            arr = arr.astype(var_out.dtype, copy=False)
+        var_out[idx] = arr
+        if self.qa is not None:
+            self.qa.update(var_out, arr)
+
+    def _finish(self, var_out):
+        '''
+        Store the QA statistics on a completed output variable and flush to disk
+        '''
+        if self.qa is not None:
+            self.qa.finalize(var_out)
+        self.sync()
 
     def regrid(self, in_ncf, bounds, rundate, layers_fn):
         '''
         the main regridding section
         sets loop over variables and decides how to regrid
+        in_ncf is either a WRF dataset or a WRFHours set of files for the run date
         '''
-        time_slice = self.find_date(in_ncf.variables['Times'], rundate) 
-        # Define the layer mapping if the WRF layers > MCIP layers
-        if in_ncf.dimensions['bottom_top'].size != self.LAYERS:
-            layer_idx = self.layer_map(layers_fn)
-        else:
-            layer_idx = [x for x in range(layers)]
-        # Staggered layer index
-        stag_idx = [0,]+[x+1 for x in layer_idx]
-        # Loop through and subset each species variable
-        for varname, dims in vardefs.metvars.items():
-            print(varname, flush=True)
-            var = in_ncf.variables[varname]
-            var_out = self.createVariable(varname, np.float32, dims)
-            for att in ['description','units','stagger','coordinates']:
-                setattr(var_out, att, getattr(var, att))
-            # Differentiate staggered and unstaggered col/rows
-            if 'south_north_stag' in dims:
-                row_slice, col_slice = self._cell_slice(bounds, row_stag=True)
-            elif 'west_east_stag' in dims:
-                row_slice, col_slice = self._cell_slice(bounds, col_stag=True)
-            else:
-                row_slice, col_slice = self._cell_slice(bounds)
-            # Differentiate staggered and unstaggered layers
-            if 'bottom_top' in dims:
-                lay_slice = layer_idx
-            elif 'bottom_top_stag' in dims:
-                lay_slice = stag_idx
-            if len(var.shape) == 3:
-                var_out[:] = var[time_slice,row_slice,col_slice]
-            else:
-                var_out[:] = var[time_slice,lay_slice,row_slice,col_slice]
-            self.sync() 
+        InMAPSet([self,], [bounds,]).regrid(in_ncf, rundate, layers_fn)
 
     def layer_map(self, fn):
         '''
         Map the layers from one definition to another
         Where lay1 is the layer set you map from and lay2 is the target layer set
         '''
-        df = pd.read_csv(fn, usecols=['lay1','lay2'])
-        return [x-1 for x in df['lay1'].values]
+        return read_layer_map(fn)
 
     def _cell_slice(self, bounds, col_stag=False, row_stag=False):
         """
@@ -80,10 +86,7 @@ class InMAP(ncf.Dataset):
         '''
         Find the index for the first and last hour of the run date in the wrf output file
         '''
-        dates = []
-        for dt in times:
-            dt = ''.join([c.decode() for c in dt])
-            dates.append(dt[:4]+dt[5:7]+dt[8:10]+dt[11:13])
+        dates = wrf_dates(times)
         try:
             start_time = dates.index(str(rundate)+'00')
         except ValueError:
@@ -95,112 +98,381 @@ class InMAP(ncf.Dataset):
         else:
             return slice(start_time, end_time+1)
 
-    def set_dims(self, in_ncf, out_grid):
+    def set_dims(self, in_ncf, out_grid, ntimes=24):
         '''
         Set up the outfile dimensions and attributes based on the new grid
         and the input file
         '''
-        out_dims = {'Time': 24, 'bottom_top': self.LAYERS, 'bottom_top_stag': self.LAYERS+1,
+        out_dims = {'Time': ntimes, 'bottom_top': self.LAYERS, 'bottom_top_stag': self.LAYERS+1,
           'south_north': out_grid.NROWS, 'south_north_stag': out_grid.NROWS+1, 
           'west_east': out_grid.NCOLS, 'west_east_stag': out_grid.NCOLS+1} 
         for dim, value in out_dims.items(): 
             self.createDimension(dim, int(value))
-        inatts_ = in_ncf.__dict__
         for att_name in in_ncf.ncattrs():
-            setattr(self, att_name, inatts_.get(att_name)) 
+            setattr(self, att_name, in_ncf.getncattr(att_name))
 
-    def append_alt(self, dens):
+    def set_proj_atts(self, out_grid):
+        '''
+        Replace the WRF projection attributes with those of the output grid
+        Used when the WRF fields are interpolated from another projection
+        '''
+        att_pairs = {'TRUELAT1': 'P_ALP', 'TRUELAT2': 'P_BET', 'STAND_LON': 'XCENT',
+          'MOAD_CEN_LAT': 'YCENT', 'DX': 'XCELL', 'DY': 'YCELL'}
+        for wrfatt, gridatt in att_pairs.items():
+            setattr(self, wrfatt, np.float32(getattr(out_grid, gridatt)))
+        self.MAP_PROJ = np.int32(1 if int(out_grid.GDTYP) == 2 else out_grid.GDTYP)
+
+    def append_alt(self, dens, desc='Inverse MCIP DENS'):
         '''
         Append the inverse density from the MCIP
         '''
+        InMAPSet([self,]).append_alt([dens,], desc)
+
+    def append_cmaq(self, cmaq, fill=None):
+        '''
+        Append the CMAQ concentrations if they are already in the defined CMAQ output file
+        '''
+        InMAPSet([self,]).append_cmaq(cmaq, fill)
+
+    def append_calc_cmaq(self, cmaq, dens, mech, fill=None):
+        '''
+        Calculate the partitioning variables from the CMAQ concentrations and append to the netCDF
+        '''
+        InMAPSet([self,]).append_calc_cmaq(cmaq, [dens,], mech, fill)
+
+class InMAPSet:
+    """
+    Several InMAP outputs filled from a single read of each input variable
+    Each output has its own GridBounds in the WRF grid and, when the outputs are windows of the
+    CMAQ grid, its own GridBounds in the CMAQ grid. The inputs are read once for the union of
+    the windows and sliced into each output.
+    """
+    def __init__(self, outputs, wrf_bounds=None, cmaq_bounds=None, static_outputs=None, extract=None,
+      quicklook=None):
+        self.outputs = list(outputs)
+        self.wrf_bounds = wrf_bounds
+        self.cmaq_bounds = cmaq_bounds
+        # Companion files for the time-invariant fields, None for a file that is already written
+        self.static_outputs = static_outputs
+        # ExtractCache that the IOAPI inputs are read through
+        self.extract = extract
+        # QuickLook subset of the hours and layers and stride of the cells
+        self.quicklook = quicklook
+
+    def tsteps(self):
+        '''
+        The input records (hours) of the run date to write
+        '''
+        if self.quicklook is None:
+            return 24
+        return self.quicklook.hours
+
+    def layers(self):
+        '''
+        The output layers to read from the IOAPI inputs, None for all of them
+        '''
+        if self.quicklook is None:
+            return None
+        return self.quicklook.layers
+
+    def reader(self, ds, varnames, fill=None, prefetch=()):
+        '''
+        Record reader for an IOAPI input over the cmaq_slices window
+        With an extract cache the prefetch variables are extracted along with the variables
+        '''
+        if self.extract is None:
+            return RecordReader(ds, varnames, fill, self.cmaq_slices(), self.layers())
+        return ExtractReader(self.extract, ds, varnames, fill, self.cmaq_slices(), prefetch, self.layers())
+
+    def cmaq_slices(self):
+        '''
+        The row and column slices of the CMAQ grid to read for all of the outputs
+        '''
+        if self.cmaq_bounds is None:
+            return (slice(None), slice(None))
+        return UnionBounds(self.cmaq_bounds).window()
+
+    def _cmaq_local(self):
+        '''
+        The row and column slices of each output within the CMAQ read window
+        With a quick-look the slices are strided to the cells of the coarse grid
+        '''
+        if self.cmaq_bounds is None:
+            local = [(slice(None), slice(None)) for out_ncf in self.outputs]
+        else:
+            union = UnionBounds(self.cmaq_bounds)
+            local = [union.local_slice(bounds) for bounds in self.cmaq_bounds]
+        if self.quicklook is None:
+            return local
+        return [(self.quicklook.sample(rows.start, out_ncf.dimensions['south_north'].size),
+          self.quicklook.sample(cols.start, out_ncf.dimensions['west_east'].size))
+          for out_ncf, (rows, cols) in zip(self.outputs, local)]
+
+    def local_arrays(self, arr):
+        '''
+        Slice an array read for the cmaq_slices window into each output
+        '''
+        return [arr[...,rows,cols] for rows, cols in self._cmaq_local()]
+
+    def regrid(self, in_ncf, rundate, layers_fn, derive_dens=False):
+        '''
+        the main regridding section
+        sets loop over variables and decides how to regrid
+        in_ncf is either a WRF dataset or a WRFHours set of files for the run date
+        With derive_dens the air density is calculated from the WRF arrays as they are read
+        and returned for each output
+        '''
+        if not isinstance(in_ncf, WRFHours):
+            in_ncf = WRFHours([in_ncf,], rundate)
+        first = self.outputs[0]
+        union = UnionBounds(self.wrf_bounds)
+        # Define the layer mapping if the WRF layers > MCIP layers
+        nlays = first.LAYERS
+        if self.quicklook is not None:
+            nlays = self.quicklook.nlays
+        if in_ncf.dimensions['bottom_top'].size != nlays:
+            layer_idx = first.layer_map(layers_fn)
+        else:
+            layer_idx = [x for x in range(nlays)]
+        if self.quicklook is not None:
+            layer_idx = [layer_idx[lay] for lay in self.quicklook.layers]
+        # Staggered layer index
+        stag_idx = [0,]+[x+1 for x in layer_idx]
+        # The window and layers key any cached hours and static fields
+        key = (union.irow_o, union.icol_o, union.orow_e, union.ocol_e, tuple(layer_idx))
+        in_ncf.set_key(key)
+        # Differentiate staggered and unstaggered col/rows and layers
+        windows = {}
+        for varname, dims in vardefs.metvars.items():
+            row_stag = 'south_north_stag' in dims
+            col_stag = 'west_east_stag' in dims and not row_stag
+            row_slice, col_slice = first._cell_slice(union, col_stag, row_stag)
+            if 'bottom_top' in dims:
+                lay_slice = layer_idx
+            elif 'bottom_top_stag' in dims:
+                lay_slice = stag_idx
+            else:
+                lay_slice = None
+            windows[varname] = (row_stag, col_stag, lay_slice, row_slice, col_slice)
+        dens_arrs = {}
+        if derive_dens:
+            missing = [varname for varname in vardefs.dens_vars if varname not in in_ncf.variables]
+            if missing:
+                raise ValueError('Missing %s in WRF for the density' %', '.join(missing))
+            for varname in vardefs.dens_dims:
+                row_slice, col_slice = first._cell_slice(union)
+                windows[varname] = (False, False, layer_idx, row_slice, col_slice)
+        # Read the time-invariant fields once
+        static = {}
+        for varname in vardefs.static_vars:
+            if varname in vardefs.metvars:
+                arr = in_ncf.read_static(varname, *windows[varname][2:])
+                if arr is not None:
+                    static[varname] = arr
+        # Find the records for the run date
+        varnames = [varname for varname in vardefs.metvars if varname not in static]
+        if derive_dens:
+            varnames += list(vardefs.dens_dims)
+        in_ncf.locate(varnames, key)
+        # Interpolated wind components held until both can be rotated, by output
+        winds = {}
+        # Loop through and subset each species variable
+        for varname, dims in vardefs.metvars.items():
+            print(varname, flush=True)
+            var = in_ncf.variables[varname]
+            row_stag, col_stag, lay_slice, row_slice, col_slice = windows[varname]
+            if varname in static:
+                arr = static[varname]
+            else:
+                arr = in_ncf.read(varname, lay_slice, row_slice, col_slice)
+            if derive_dens and varname in vardefs.dens_vars:
+                dens_arrs[varname] = arr
+            for idx, (out_ncf, bounds) in enumerate(zip(self.outputs, self.wrf_bounds)):
+                if varname in static and self.static_outputs is not None:
+                    # Time-invariant fields go to the static companion file when it is written
+                    out_ncf = self.static_outputs[idx]
+                    if out_ncf is None:
+                        continue
+                var_out = out_ncf.createVariable(varname, np.float32, dims)
+                for att in ['description','units','stagger','coordinates']:
+                    setattr(var_out, att, getattr(var, att))
+                rotate = varname in vardefs.wind_vars and getattr(bounds, 'rotate_winds', False)
+                if rotate:
+                    var_out.description = '%s, rotated from the WRF grid to this projection' %var.description
+                rows, cols = union.local_slice(bounds, col_stag, row_stag)
+                out_arr = arr[...,rows,cols]
+                if rotate:
+                    # The winds are interpolated and rotated together once both are read
+                    winds.setdefault(idx, {})[varname] = (out_ncf, var_out, out_arr)
+                    if len(winds[idx]) < len(vardefs.wind_vars):
+                        continue
+                    pair = winds.pop(idx)
+                    u, v = [pair[name] for name in vardefs.wind_vars]
+                    rot_u, rot_v = bounds.rotate(u[2], v[2])
+                    writes = [u[:2] + (rot_u,), v[:2] + (rot_v,)]
+                else:
+                    if hasattr(bounds, 'apply'):
+                        # Interpolate from a WRF grid in another projection or decimate
+                        out_arr = bounds.apply(out_arr, row_stag, col_stag, varname in vardefs.categorical)
+                    if out_arr.shape[0] != var_out.shape[0]:
+                        # Repeat a time-invariant field for every hour
+                        out_arr = out_arr.repeat(var_out.shape[0], axis=0)
+                    writes = [(out_ncf, var_out, out_arr),]
+                for out_ncf, var_out, out_arr in writes:
+                    out_ncf._write(var_out, out_arr)
+                    out_ncf._finish(var_out)
+        if derive_dens:
+            return self._wrf_dens(in_ncf, union, windows, dens_arrs)
+
+    def _wrf_dens(self, in_ncf, union, windows, dens_arrs):
+        '''
+        Calculate the density for the WRF read window from the P, PB and T already read and the
+        moisture, then window or interpolate it to each output like the other WRF fields
+        '''
+        print('Density from WRF', flush=True)
+        for varname in vardefs.dens_dims:
+            dens_arrs[varname] = in_ncf.read(varname, *windows[varname][2:])
+        dens = wrf_dens(*[dens_arrs[varname] for varname in vardefs.dens_vars])
+        out_dens = []
+        for bounds in self.wrf_bounds:
+            rows, cols = union.local_slice(bounds)
+            arr = dens[...,rows,cols]
+            if hasattr(bounds, 'apply'):
+                arr = bounds.apply(arr)
+            out_dens.append(arr)
+        return out_dens
+
+    def append_alt(self, dens, desc='Inverse MCIP DENS'):
+        '''
+        Append the inverse density
+        dens is a list of the density on each output grid
+        '''
         print('ALT', flush=True)
         dims = ['Time','bottom_top','south_north','west_east']
-        var_out = self.createVariable('ALT', np.float32, dims)
-        var_out.description = 'Inverse MCIP DENS'
-        var_out.units = 'm**3/kg'
-        arr = dens[:24,:]
-        if arr.shape == var_out.shape:
-            var_out[:] = 1/arr
-            self.sync()
-        else:
-            print(arr.shape, var_out.shape)
-            raise ValueError('Input shape of DENS does not match output dimensions')
+        for out_ncf, arr in zip(self.outputs, dens):
+            var_out = out_ncf.createVariable('ALT', np.float32, dims)
+            var_out.description = desc
+            var_out.units = 'm**3/kg'
+            if arr.shape == var_out.shape:
+                out_ncf._write(var_out, 1/arr)
+                out_ncf._finish(var_out)
+            else:
+                print(arr.shape, var_out.shape)
+                raise ValueError('Input shape of DENS does not match output dimensions')
 
-    def append_cmaq(self, cmaq):
+    def append_cmaq(self, cmaq, fill=None):
         '''
         Append the CMAQ concentrations if they are already in the defined CMAQ output file
+        The file records are read once, in order, and every variable is written hour by hour
         '''
         dims = ['Time','bottom_top','south_north','west_east']
-        for varname in vardefs.cmaq_vars:
-            print(varname)
-            var = cmaq.variables[varname]
-            var_out = self.createVariable(varname, np.float32, dims)
-            var_out.description = var.var_desc
-            var_out.units = var.units
-            var_out[:] = var[:24,:]
-            self.sync()
-     
-    def append_calc_cmaq(self, cmaq, dens, mech):
+        reader = self.reader(cmaq, vardefs.cmaq_vars, fill, vardefs.all_cmaq_species())
+        if reader.missing:
+            raise KeyError('Missing %s in CMAQ conc' %', '.join(reader.missing))
+        outs_vars = []
+        for out_ncf in self.outputs:
+            vars_out = {}
+            for varname in vardefs.cmaq_vars:
+                var = cmaq.variables[varname]
+                var_out = out_ncf.createVariable(varname, np.float32, dims)
+                var_out.description = var.var_desc
+                var_out.units = var.units
+                vars_out[varname] = var_out
+            outs_vars.append(vars_out)
+        local = self._cmaq_local()
+        for tstep, conc in reader.records(self.tsteps()):
+            print('Hour %s' %tstep, flush=True)
+            for out_ncf, vars_out, (rows, cols) in zip(self.outputs, outs_vars, local):
+                for varname, var_out in vars_out.items():
+                    out_ncf._write(var_out, conc[varname][:,rows,cols], tstep)
+        for out_ncf, vars_out in zip(self.outputs, outs_vars):
+            for var_out in vars_out.values():
+                out_ncf._finish(var_out)
+
+    def append_calc_cmaq(self, cmaq, dens, mech, fill=None):
         '''
         Calculate the partitioning variables from the CMAQ concentrations and append to the netCDF
+        The CMAQ records are read once, in order, and the variables are calculated hour by hour
+        for each output
+        dens is a list of the density on each output grid
         '''
         vardefs.set_mech(mech)
         dims = ['Time','bottom_top','south_north','west_east']
-        for varname, desc in vardefs.cmaq_map.items():
-            print(varname, flush=True)
-            var_out = self.createVariable(varname, np.float32, dims)
-            arr_out = np.zeros(var_out.shape)
-            var_out.description = '+'.join(desc['species'])
-            var_out.units = desc['units']
-            for spec in desc['species']:
-                if desc['type'] == 'gas':
-                    if desc['units'] == 'ppbC':
-                        coeff = vardefs.mw[spec] * 1000
-                    else:
-                        coeff = vardefs.mw[spec] * 1000 * dens[:24,:] / 28.9647
-                else:
-                    coeff = 1
-                try:
-                    var = cmaq.variables[spec]
-                except KeyError:
-                    print('WARNING: Missing %s in CMAQ conc' %spec)
+        outs_vars = []
+        for out_ncf in self.outputs:
+            vars_out = {}
+            for varname, desc in vardefs.cmaq_map.items():
+                var_out = out_ncf.createVariable(varname, np.float32, dims)
+                var_out.description = '+'.join(desc['species'])
+                var_out.units = desc['units']
+                vars_out[varname] = var_out
+            var_out = out_ncf.createVariable('NO_NO2partitioning', np.float32, dims)
+            var_out.description = 'NO/(NO+NO2)'
+            var_out.units = 'fraction'
+            vars_out[var_out.name] = var_out
+            for varname, desc in vardefs.partitions.items():
+                var_out = out_ncf.createVariable(varname, np.float32, dims)
+                var_out.description = '%s/(%s)' %(desc['num'], '+'.join(desc['den']))
+                var_out.units = 'fraction'
+                vars_out[varname] = var_out
+            outs_vars.append(vars_out)
+        reader = self.reader(cmaq, vardefs.cmaq_species() + ['NO','NO2'], fill, vardefs.all_cmaq_species())
+        for spec in reader.missing:
+            print('WARNING: Missing %s in CMAQ conc' %spec)
+        local = self._cmaq_local()
+        for tstep, conc in reader.records(self.tsteps()):
+            print('Hour %s' %tstep, flush=True)
+            for out_ncf, vars_out, (rows, cols), out_dens in zip(self.outputs, outs_vars, local, dens):
+                out_conc = dict((spec, arr[:,rows,cols]) for spec, arr in conc.items())
+                arrs = {}
+                for varname, desc in vardefs.cmaq_map.items():
+                    arrs[varname] = self.calc_cmaq_var(out_conc, out_dens[tstep], desc)
+                arrs['NO_NO2partitioning'] = self.calc_no_part(out_conc)
+                arrs.update(self.calc_other_part(arrs))
+                for varname, var_out in vars_out.items():
+                    out_ncf._write(var_out, arrs[varname], tstep)
+        for out_ncf, vars_out in zip(self.outputs, outs_vars):
+            for var_out in vars_out.values():
+                out_ncf._finish(var_out)
+
+    def calc_cmaq_var(self, conc, dens, desc):
+        '''
+        Sum the species for one output variable and time step, converting the gases to mass
+        '''
+        # Masked reads keep the masked values out of the sums
+        arr_out = np.ma.zeros(dens.shape) if np.ma.isMaskedArray(dens) else np.zeros(dens.shape)
+        for spec in desc['species']:
+            if spec not in conc:
+                continue
+            if desc['type'] == 'gas':
+                if desc['units'] == 'ppbC':
+                    coeff = vardefs.mw[spec] * 1000
                 else:
-                    arr_out += var[:24,:] * coeff
-            var_out[:] = arr_out[:]
-            self.sync()
-        self.calc_no_part(cmaq, dims)
-        self.calc_other_part(cmaq, dims)
+                    coeff = np.multiply(vardefs.mw[spec] * 1000, dens, dtype=np.float64) / 28.9647
+            else:
+                coeff = 1
+            # In double precision for both read modes, a float32 array times a float stays float32
+            arr_out += np.multiply(conc[spec], coeff, dtype=np.float64)
+        return arr_out
 
-    def calc_no_part(self, cmaq, dims):
+    def calc_no_part(self, conc):
         '''
-        Calculate and fill the NO/NO2 partition
+        Calculate the NO/NO2 partition for a time step
         '''
-        var_out = self.createVariable('NO_NO2partitioning', np.float32, dims)
-        var_out.description = 'NO/(NO+NO2)'
-        var_out.units = 'fraction'
-        var_out[:] = cmaq.variables['NO'][:24,:] / (cmaq.variables['NO'][:24,:] +\
-          cmaq.variables['NO2'][:24,:])
-        self.sync()
+        return conc['NO'] / (conc['NO'] + conc['NO2'])
 
-    def calc_other_part(self, cmaq, dims):
+    def calc_other_part(self, arrs):
         '''
-        Calc partitions from previously calculated vars
+        Calc partitions from previously calculated vars for a time step
         '''
-        partitions = {'bOrgPartitioning': {'num': 'bSOA', 'den': ['bSOA','bVOC']},
-          'aOrgPartitioning': {'num': 'aSOA', 'den': ['aSOA','aVOC']},
-          'NHPartitioning': {'num': 'pNH', 'den': ['gNH','pNH']},
-          'NOPartitioning': {'num': 'pNO', 'den': ['gNO','pNO','gN']},
-          'SPartitioning': {'num': 'pS', 'den': ['gS','pS']}}
-        for varname, desc in partitions.items():
-            print(varname, flush=True)
-            var_out = self.createVariable(varname, np.float32, dims)
-            var_out.description = '%s/(%s)' %(desc['num'], '+'.join(desc['den']))
-            var_out.units = 'fraction'
-            arr_out = np.zeros(var_out.shape)
+        parts = {}
+        for varname, desc in vardefs.partitions.items():
+            num = arrs[desc['num']]
+            arr_out = np.ma.zeros(num.shape) if np.ma.isMaskedArray(num) else np.zeros(num.shape)
             for poll in desc['den']:
-                arr_out += self.variables[poll][:]
-            var_out[:] = self.variables[desc['num']][:] / arr_out
-            self.sync()
+                arr_out += arrs[poll]
+            parts[varname] = num / arr_out
+        return parts
 
 if __name__ == '__main__':
 	main()
@@ -0,0 +1,94 @@
+# Record-wise reading of IOAPI files such as CCTM_CONC and METCRO3D
+#
+# IOAPI files are netCDF3 files with TSTEP as the record dimension, so each variable is
+#  stored in pieces spread across every record. Reading one variable at a time strides
+#  through the whole file once per variable. These routines walk the records in order,
+#  once, and pull every requested variable out of each record.
+
+import numpy as np
+
+def tstep_list(nsteps):
+    '''
+    The records for a number of steps from the start or a list of records
+    '''
+    if isinstance(nsteps, int):
+        return list(range(nsteps))
+    return list(nsteps)
+
+class RecordReader:
+    """
+    Read a set of variables from an IOAPI file one record (time step) at a time
+    """
+    def __init__(self, ncf, varnames, fill=None, window=None, layers=None):
+        self.ncf = ncf
+        # FillPolicy for datasets read without the auto-masking
+        self.fill = fill
+        # Row and column slices to read, the whole grid by default
+        if window is None:
+            window = (slice(None), slice(None))
+        self.window = tuple(window)
+        # Layer indices to read, all layers by default
+        self.layers = layers
+        # Keep the variables in file order so that each record is read front to back
+        file_order = list(ncf.variables)
+        varnames = list(dict.fromkeys(varnames))
+        self.varnames = sorted([name for name in varnames if name in ncf.variables],
+          key=file_order.index)
+        self.missing = [name for name in varnames if name not in ncf.variables]
+
+    def _buffers(self, nsteps=None):
+        '''
+        Preallocate the per-variable arrays, for one record or for nsteps records
+        '''
+        bufs = {}
+        for name in self.varnames:
+            var = self.ncf.variables[name]
+            nrows, ncols = var.shape[-2:]
+            lays = var.shape[1:-2]
+            if self.layers is not None:
+                lays = (len(self.layers),)
+            shape = lays + (len(range(*self.window[0].indices(nrows))),
+              len(range(*self.window[1].indices(ncols))))
+            if nsteps is not None:
+                shape = (nsteps,) + shape
+            if self.fill is None:
+                # Masked reads keep their mask, as var[:] would
+                bufs[name] = np.ma.masked_array(np.empty(shape, var.dtype), np.zeros(shape, bool))
+            else:
+                bufs[name] = np.empty(shape, self.fill.dtype(var))
+        return bufs
+
+    def _read(self, name, tstep):
+        var = self.ncf.variables[name]
+        if self.layers is None:
+            arr = var[(tstep, Ellipsis) + self.window]
+        else:
+            arr = var[(tstep, self.layers) + self.window]
+        if self.fill is None:
+            return arr
+        return self.fill.apply(var, arr)
+
+    def records(self, nsteps=24):
+        '''
+        Yield the time step index and a dictionary of the variables for that record
+        nsteps is the number of records from the start or a list of the records to read,
+        the index is then the position in the list
+        The per-variable arrays are reused between records
+        '''
+        bufs = self._buffers()
+        for idx, tstep in enumerate(tstep_list(nsteps)):
+            for name in self.varnames:
+                bufs[name][:] = self._read(name, tstep)
+            yield idx, bufs
+
+    def read(self, nsteps=24):
+        '''
+        Read the first nsteps records, or the listed records, of every variable into
+        preallocated arrays
+        '''
+        tsteps = tstep_list(nsteps)
+        arrs = self._buffers(len(tsteps))
+        for idx, tstep in enumerate(tsteps):
+            for name in self.varnames:
+                arrs[name][idx] = self._read(name, tstep)
+        return arrs
@@ -0,0 +1,143 @@
+# Streaming QA statistics collected while the InMAP variables are written
+
+import numpy as np
+import pandas as pd
+
+class VarStats:
+    """
+    Running statistics for a single output variable
+    """
+    def __init__(self, name, units='', valid_range=(None, None)):
+        self.name = name
+        self.units = units
+        self.valid_min, self.valid_max = valid_range
+        self.count = 0
+        self.total = 0.
+        self.vmin = np.inf
+        self.vmax = -np.inf
+        self.nan_count = 0
+        self.inf_count = 0
+        self.masked_count = 0
+        self.below_count = 0
+        self.above_count = 0
+
+    def update(self, arr):
+        '''
+        Add a block of values (the whole variable or a single time step) to the statistics
+        '''
+        data = np.ma.getdata(arr)
+        mask = np.ma.getmaskarray(arr)
+        self.masked_count += int(mask.sum())
+        nan = np.isnan(data) & ~mask
+        inf = np.isinf(data) & ~mask
+        self.nan_count += int(nan.sum())
+        self.inf_count += int(inf.sum())
+        vals = data[~(mask | nan | inf)]
+        if vals.size:
+            self.count += vals.size
+            self.total += float(vals.sum(dtype=np.float64))
+            self.vmin = min(self.vmin, float(vals.min()))
+            self.vmax = max(self.vmax, float(vals.max()))
+            if self.valid_min is not None:
+                self.below_count += int((vals < self.valid_min).sum())
+            if self.valid_max is not None:
+                self.above_count += int((vals > self.valid_max).sum())
+
+    @property
+    def out_of_range(self):
+        return self.below_count + self.above_count
+
+    @property
+    def mean(self):
+        if self.count:
+            return self.total / self.count
+        return np.nan
+
+    def as_dict(self):
+        '''
+        Return the statistics as a flat dictionary for the summary report
+        '''
+        return {'variable': self.name, 'units': self.units,
+          'min': self.vmin if self.count else np.nan, 'max': self.vmax if self.count else np.nan,
+          'mean': self.mean, 'count': self.count, 'nan_count': self.nan_count,
+          'inf_count': self.inf_count, 'masked_count': self.masked_count,
+          'below_range_count': self.below_count, 'above_range_count': self.above_count}
+
+class QAStats:
+    """
+    Collect per-variable QA statistics in the same pass as the output writes
+
+    Optional fail-fast thresholds on the number of NaN, inf and out-of-range values
+    raise a ValueError as soon as a written block exceeds them.
+    """
+    def __init__(self, vardefs, max_nan=None, max_inf=None, max_out_of_range=None):
+        self.vardefs = vardefs
+        self.max_nan = max_nan
+        self.max_inf = max_inf
+        self.max_out_of_range = max_out_of_range
+        self.stats = {}
+
+    def valid_range(self, varname, units):
+        '''
+        Look up the physically valid range for a variable by name then by units
+        The units are compared case-insensitively, ie. ppmV and ppmv
+        '''
+        if varname in self.vardefs.qa_ranges:
+            return self.vardefs.qa_ranges[varname]
+        unit_ranges = dict((key.lower(), valid) for key, valid in self.vardefs.qa_unit_ranges.items())
+        return unit_ranges.get(units.strip().lower(), (None, None))
+
+    def update(self, var_out, arr):
+        '''
+        Update the statistics for an output variable with the block that was just written
+        '''
+        stats = self.stats.get(var_out.name)
+        if stats is None:
+            units = getattr(var_out, 'units', '')
+            stats = VarStats(var_out.name, units, self.valid_range(var_out.name, units))
+            self.stats[var_out.name] = stats
+        stats.update(arr)
+        self.check(stats)
+
+    def check(self, stats):
+        '''
+        Raise a fatal error if the variable exceeds one of the fail-fast thresholds
+        Masked values count as NaN, as they are NaN in the unmasked reads, ie. a 0/0 partition
+        '''
+        limits = (('NaN or masked', stats.nan_count + stats.masked_count, self.max_nan), ('inf', stats.inf_count, self.max_inf),
+          ('out of range', stats.out_of_range, self.max_out_of_range))
+        for label, count, limit in limits:
+            if limit is not None and count > limit:
+                raise ValueError('QA failure: %s has %s %s values (limit %s)' %(stats.name, count, label, limit))
+
+    def finalize(self, var_out):
+        '''
+        Store the statistics for a completed variable as variable attributes
+        '''
+        stats = self.stats.get(var_out.name)
+        if stats is None:
+            return
+        vals = stats.as_dict()
+        for key in ('min','max','mean'):
+            setattr(var_out, 'qa_%s' %key, np.float32(vals[key]))
+        for key in ('nan_count','inf_count','masked_count','below_range_count','above_range_count'):
+            setattr(var_out, 'qa_%s' %key, np.int32(vals[key]))
+
+    def summary(self):
+        '''
+        Return the summary of all written variables as a list of dictionaries
+        '''
+        return [stats.as_dict() for stats in self.stats.values()]
+
+    def problems(self):
+        '''
+        List the variables that have any NaN, masked, inf or out-of-range values
+        '''
+        return [stats.name for stats in self.stats.values() if stats.nan_count or
+          stats.masked_count or stats.inf_count or stats.out_of_range]
+
+    def write_report(self, fn):
+        '''
+        Write the summary report to a CSV file
+        '''
+        pd.DataFrame(self.summary()).to_csv(fn, index=False)
@@ -0,0 +1,248 @@
+# Header-only validation of the inputs for a day or a whole batch before it is launched
+#
+# Only the file headers (and the small WRF Times variable) are read, so problems such as a
+#  missing file, incomplete time coverage, mismatched grids or dimensions and missing CMAQ
+#  species are reported in seconds instead of after a day has spent minutes on I/O.
+
+import io
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack, redirect_stdout
+from datetime import datetime, timedelta
+from optparse import OptionGroup
+from wrfcmaq2inmap import cli
+
+def check_day(wrf, mcip, cmaq, rundate, options):
+    '''
+    Check the inputs for one day
+    Returns a list of (level, message) problems. ERROR problems would stop the run.
+    '''
+    import netCDF4 as ncf
+    from wrfcmaq2inmap.gridtools import GridDef, GridBounds, output_grids
+    from wrfcmaq2inmap.inmap import read_layer_map
+    from wrfcmaq2inmap.vardefs import VarDefs
+    from wrfcmaq2inmap.wrfsource import WRFHours
+    problems = []
+    vardefs = VarDefs()
+    rundate = str(rundate)
+    try:
+        jdate = int(datetime.strptime(rundate, '%Y%m%d').strftime('%Y%j'))
+    except ValueError:
+        return [('ERROR', 'Invalid run date %s' %rundate)]
+    wrf_files = wrf.split(',')
+    for path in wrf_files + [mcip,] + cmaq.split(','):
+        if not os.path.exists(path):
+            problems.append(('ERROR', 'Missing file %s' %path))
+    in_grid = out_grid = None
+    wrf_lays = lays = None
+    if all(os.path.exists(path) for path in wrf_files):
+        try:
+            with WRFHours(wrf_files, rundate) as in_ncf:
+                varnames = list(vardefs.metvars)
+                if options.alt_source == 'wrf':
+                    varnames += [varname for varname in vardefs.dens_vars if varname not in varnames]
+                missing = [varname for varname in varnames if varname not in in_ncf.variables]
+                if missing:
+                    problems.append(('ERROR', 'Missing %s in WRF' %', '.join(missing)))
+                in_ncf.locate(list(vardefs.metvars.keys()))
+                wrf_lays = in_ncf.dimensions['bottom_top'].size
+                in_grid = GridDef()
+                in_grid.wrf_grid(in_ncf.newest)
+        except (OSError, ValueError, KeyError, AttributeError) as e:
+            problems.append(('ERROR', 'WRF: %s' %e))
+    if os.path.exists(mcip):
+        try:
+            with ncf.Dataset(mcip) as mcip_ncf:
+                out_grid = GridDef()
+                out_grid.io_grid(mcip_ncf)
+                lays = mcip_ncf.dimensions['LAY'].size
+                problems += _check_ioapi(mcip_ncf, 'METCRO3D', jdate, out_grid, lays)
+                if 'DENS' not in mcip_ncf.variables and options.alt_source != 'wrf':
+                    problems.append(('ERROR', 'Missing DENS in METCRO3D'))
+        except (OSError, KeyError, AttributeError) as e:
+            out_grid = None
+            problems.append(('ERROR', 'METCRO3D: %s' %e))
+    cmaq_files = cmaq.split(',')
+    try:
+        cli.scenario_names(cmaq_files, options.scenarios)
+    except ValueError as e:
+        problems.append(('ERROR', 'Scenarios: %s' %e))
+    for cmaq in cmaq_files:
+        if not os.path.exists(cmaq):
+            continue
+        label = 'CMAQ conc'
+        if len(cmaq_files) > 1:
+            label = 'CMAQ conc %s' %os.path.basename(cmaq)
+        try:
+            with ncf.Dataset(cmaq) as cmaq_ncf:
+                problems += _check_ioapi(cmaq_ncf, label, jdate, out_grid, lays)
+                problems += _check_species(cmaq_ncf, vardefs, options.mech)
+        except (OSError, KeyError, AttributeError) as e:
+            problems.append(('ERROR', '%s: %s' %(label, e)))
+    if in_grid is not None and out_grid is not None:
+        try:
+            bounds = GridBounds(in_grid, out_grid)
+        except ValueError as e:
+            problems.append(('WARNING', 'Grids: %s, the WRF fields will be interpolated' %e))
+        except Exception as e:
+            problems.append(('ERROR', 'Grids: %s' %e))
+        else:
+            if not bounds.inside(in_grid):
+                problems.append(('ERROR', 'Grids: the output domain is not inside the WRF domain'))
+    if options.grids and out_grid is not None:
+        try:
+            domains = output_grids(options.grids, options.griddesc)
+        except (OSError, ValueError, KeyError, AttributeError, IndexError) as e:
+            problems.append(('ERROR', 'Grids: %s' %e))
+        else:
+            for domain in domains:
+                try:
+                    if not GridBounds(out_grid, domain).inside(out_grid):
+                        problems.append(('ERROR', 'Grids: %s is not inside the METCRO3D domain' %domain.GDNAM))
+                except ValueError as e:
+                    problems.append(('ERROR', 'Grids: %s: %s' %(domain.GDNAM, e)))
+    if wrf_lays is not None and lays is not None and wrf_lays != lays:
+        if not options.layers:
+            problems.append(('ERROR', 'Layers: WRF has %s layers and METCRO3D %s but no layer mapping file is set'
+              %(wrf_lays, lays)))
+        else:
+            try:
+                layer_idx = read_layer_map(options.layers)
+            except (OSError, ValueError) as e:
+                problems.append(('ERROR', 'Layers: %s' %e))
+            else:
+                if len(layer_idx) != lays:
+                    problems.append(('ERROR', 'Layers: the layer mapping has %s layers and METCRO3D %s'
+                      %(len(layer_idx), lays)))
+                if max(layer_idx) >= wrf_lays or min(layer_idx) < 0:
+                    problems.append(('ERROR', 'Layers: the layer mapping is outside of the %s WRF layers' %wrf_lays))
+    return problems
+
+def _check_ioapi(ds, label, jdate, grid, lays):
+    '''
+    Check the time coverage and the dimensions of an IOAPI file against the output grid
+    '''
+    problems = []
+    if ds.dimensions['TSTEP'].size < 24:
+        problems.append(('ERROR', '%s has %s time steps, 24 needed' %(label, ds.dimensions['TSTEP'].size)))
+    if int(ds.SDATE) != jdate or int(ds.STIME) != 0:
+        problems.append(('ERROR', '%s starts at %s %0.6d, not the run date %s 000000'
+          %(label, ds.SDATE, ds.STIME, jdate)))
+    if grid is not None:
+        dims = (ds.dimensions['LAY'].size, ds.dimensions['ROW'].size, ds.dimensions['COL'].size)
+        if dims != (lays, int(grid.NROWS), int(grid.NCOLS)):
+            problems.append(('ERROR', '%s LAY/ROW/COL %s do not match the output %s'
+              %(label, dims, (lays, int(grid.NROWS), int(grid.NCOLS)))))
+    return problems
+
+def _check_species(ds, vardefs, mech):
+    '''
+    Check that the CMAQ species for the mechanism exist
+    Species missing from the calculated variables only give a warning, as in the processing.
+    '''
+    if mech.strip() == '':
+        missing = [varname for varname in vardefs.cmaq_vars if varname not in ds.variables]
+        return [('ERROR', 'Missing %s in CMAQ conc' %', '.join(missing))] if missing else []
+    problems = []
+    vardefs.set_mech(mech)
+    missing = [spec for spec in vardefs.cmaq_species() if spec not in ds.variables]
+    if missing:
+        problems.append(('WARNING', 'Missing %s in CMAQ conc' %', '.join(missing)))
+    missing = [spec for spec in ('NO','NO2') if spec not in ds.variables]
+    if missing:
+        problems.append(('ERROR', 'Missing %s in CMAQ conc, needed for NO_NO2partitioning' %', '.join(missing)))
+    return problems
+
+def _check_job(job):
+    # Keep the file opening messages out of the report
+    with redirect_stdout(io.StringIO()):
+        problems = check_day(*job)
+    return job[3], problems
+
+def date_jobs(wrf_tmpl, mcip_tmpl, cmaq_tmpl, start, end, options):
+    '''
+    Build the day jobs over a date range from path templates
+    The templates are formatted with the run date as "date" and the previous and next days
+    as "prev" and "next", ie. wrfout_d04_{prev:%Y-%m-%d}_12:00:00
+    '''
+    jobs = []
+    cur = datetime.strptime(str(start), '%Y%m%d')
+    end = datetime.strptime(str(end), '%Y%m%d')
+    while cur <= end:
+        fields = {'date': cur, 'prev': cur - timedelta(days=1), 'next': cur + timedelta(days=1)}
+        jobs.append((wrf_tmpl.format(**fields), mcip_tmpl.format(**fields),
+          cmaq_tmpl.format(**fields), cur.strftime('%Y%m%d'), options))
+        cur += timedelta(days=1)
+    return jobs
+
+def file_jobs(fn, options):
+    '''
+    Read the day jobs from a file of worker job lines
+    '''
+    jobs = []
+    with open(fn) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            job = json.loads(line)
+            if isinstance(job, dict) and 'cmd' in job:
+                # Worker control commands, eg. stats or shutdown
+                continue
+            if isinstance(job, dict):
+                job = job.get('args', [])
+            job_opts, args = cli.get_opts([str(arg) for arg in job])
+            if len(args) != 5:
+                raise ValueError('Job needs wrfout metcro3d cmaq_conc rundate outfile: %s' %line.strip())
+            jobs.append(tuple(args[:4]) + (job_opts,))
+    return jobs
+
+def run_checks(jobs, workers=None):
+    '''
+    Check the days in parallel and print the report
+    Returns the number of errors
+    '''
+    if not jobs:
+        return 0
+    errors = warnings = 0
+    with ExitStack() as stack:
+        if workers == 1 or len(jobs) == 1:
+            results = map(_check_job, jobs)
+        else:
+            pool = stack.enter_context(ProcessPoolExecutor(max_workers=workers))
+            results = pool.map(_check_job, jobs)
+        for rundate, problems in results:
+            for level, msg in problems:
+                print('%s %s: %s' %(rundate, level, msg), flush=True)
+                if level == 'ERROR':
+                    errors += 1
+                else:
+                    warnings += 1
+    print('Checked %s days: %s errors, %s warnings' %(len(jobs), errors, warnings), flush=True)
+    return errors
+
+def validate(argv):
+    '''
+    Check a batch of days, from path templates over a date range or from a job file
+    '''
+    parser = cli.get_parser()
+    parser.set_usage('usage: %prog validate [options] wrf_template metcro3d_template conc_template start_date end_date\n' +\
+      '       %prog validate [options] --jobs jobs_file')
+    group = OptionGroup(parser, 'Validation',
+      'Templates are formatted with the run date as {date}, and the previous and next days as {prev} '+\
+      'and {next}, ie. METCRO3D_{date:%Y%m%d}.nc')
+    group.add_option('--jobs', dest='jobs', default='',
+      help='File of worker job lines to check instead of the date range templates')
+    group.add_option('--workers', dest='workers', type='int', default=None,
+      help='Number of parallel header readers. Defaults to the number of CPUs.')
+    parser.add_option_group(group)
+    options, args = parser.parse_args(argv)
+    if options.jobs:
+        jobs = file_jobs(options.jobs, options)
+    elif len(args) == 5:
+        jobs = date_jobs(*args, options=options)
+    else:
+        parser.error('Set the path templates and date range or a jobs file')
+    if run_checks(jobs, options.workers):
+        sys.exit(1)
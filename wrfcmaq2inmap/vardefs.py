@@ -14,6 +14,25 @@ class VarDefs:
         self.mw.update(self.nonvoc_coeff)
         self.cmaq_map.update(self.nonvoc_map)
 
+    def cmaq_species(self):
+        '''
+        List the CMAQ species needed for the current mechanism
+        '''
+        species = []
+        for desc in self.cmaq_map.values():
+            species.extend(desc['species'])
+        return list(dict.fromkeys(species))
+
+    def all_cmaq_species(self):
+        '''
+        List the CMAQ species for every mechanism and the precalculated variables
+        '''
+        species = list(self.cmaq_vars) + ['NO','NO2']
+        for cmaq_map in (self.cb6_map, self.saprc_map, self.nonvoc_map):
+            for desc in cmaq_map.values():
+                species.extend(desc['species'])
+        return list(dict.fromkeys(species))
+
     def _init_vars(self):
         # Set the input WRF variables
         self.metvars = {
@@ -34,6 +53,20 @@ class VarDefs:
         'UST': ('Time','south_north','west_east'),
         'PBLH': ('Time','south_north','west_east'),
         'LU_INDEX': ('Time','south_north','west_east')}
+        # Static and base-state fields that do not change over time, read and stored once
+        self.static_vars = ['PHB','PB','LU_INDEX']
+        # WRF fields for the density with --alt-source wrf, in the argument order of wrf_dens
+        self.dens_vars = ['P','PB','T','QVAPOR']
+        self.dens_dims = {'QVAPOR': ('Time','bottom_top','south_north','west_east')}
+        # Grid-relative wind components
+        self.wind_vars = ['U','V']
+        # Categorical fields take the nearest WRF cell when interpolated between projections
+        self.categorical = ['LU_INDEX',]
+        # Physically valid ranges used by the QA statistics, by variable name then by units
+        self.qa_ranges = {'QRAIN': (0, None), 'QCLOUD': (0, None), 'CLDFRA': (0, 1),
+          'GLW': (0, None), 'SWDOWN': (0, None), 'UST': (0, None), 'PBLH': (0, None)}
+        self.qa_unit_ranges = {'fraction': (0, 1), 'ug/m3': (0, None), 'ppbC': (0, None),
+          'ppmV': (0, None), 'm**3/kg': (0, None)}
         # CMAQ variables to write to InMAP file
         self.cmaq_vars = ['TotalPM25','gS','pS','aVOC','bVOC','aSOA','bSOA','oh','h2o2','pNO','gNO','pNH','gNH']
         # Mapping for non-VOC clumps
@@ -60,6 +93,12 @@ class VarDefs:
           'pS': {'type': 'aero', 'units': 'ug/m3', 'species': ['ASO4I','ASO4J']},
           'gN': {'type': 'gas', 'units': 'ug/m3', 'species': ['NO3','N2O5','N2O5','HONO','HNO3','PNA',
              'CRON','CLNO2','PAN','PANX','OPAN','NTR1','NTR2','INTR']}}
+        # Partitioning fractions calculated from the CMAQ output variables
+        self.partitions = {'bOrgPartitioning': {'num': 'bSOA', 'den': ['bSOA','bVOC']},
+          'aOrgPartitioning': {'num': 'aSOA', 'den': ['aSOA','aVOC']},
+          'NHPartitioning': {'num': 'pNH', 'den': ['gNH','pNH']},
+          'NOPartitioning': {'num': 'pNO', 'den': ['gNO','pNO','gN']},
+          'SPartitioning': {'num': 'pS', 'den': ['gS','pS']}}
         # Coefficients for CB6 calculations (MW)
         self.cb6_coeff = {'PAR': 72.1, 'ETH': 28, 'ETHY': 26, 'MEOH': 32, 'ETOH': 46.1, 'OLE': 42.1, 'TOL': 92.1, 
           'XYLMN': 106.2, 'FORM': 30, 'ALD2': 44, 'ETHA': 30.1, 'IOLE': 56.1, 'ALDX': 58.1, 'NAPH': 128.2, 
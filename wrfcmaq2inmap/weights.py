@@ -0,0 +1,228 @@
+# Interpolation weights between WRF and output grids in different projections
+#
+# GridBounds can only window a WRF grid that shares the projection and cell size of the
+#  output grid. Otherwise every output point is interpolated from the WRF points with
+#  bilinear or area-weighted weights. The geometry is computed once for each pair of grid
+#  definitions, cached on disk and applied to every variable and hour as a sparse product
+#  with a fixed number of weights per output point.
+
+import hashlib
+import os
+import numpy as np
+from wrfcmaq2inmap.gridtools import GridBounds, get_proj, rotate_winds
+
+methods = ('bilinear','area')
+# Staggers by (row_stag, col_stag)
+staggers = {(False, False): 'mass', (True, False): 'row', (False, True): 'col'}
+# Weights already loaded in this process, for workers that process several days
+loaded = {}
+
+def wrf_window(in_grid, out_grid, method='bilinear', cache_dir=''):
+    '''
+    GridBounds when the output grid is a window of the WRF grid, otherwise GridWeights
+    '''
+    try:
+        in_grid.check_grids(out_grid)
+    except ValueError as e:
+        print('%s: interpolating WRF with %s weights' %(e, method), flush=True)
+    else:
+        return GridBounds(in_grid, out_grid)
+    return GridWeights(in_grid, out_grid, method, cache_dir)
+
+def grid_key(in_grid, out_grid, method):
+    '''
+    Key for the weights from both grid definitions and the method
+    '''
+    atts = ['GDTYP','P_ALP','P_BET','P_GAM','XCENT','YCENT','XORIG','YORIG','XCELL','YCELL','NCOLS','NROWS']
+    desc = [method,] + ['%s=%r' %(att, float(getattr(grid, att))) for grid in (in_grid, out_grid) for att in atts]
+    return hashlib.sha1(' '.join(desc).encode()).hexdigest()[:16]
+
+class GridWeights:
+    """
+    Sparse interpolation weights from the WRF grid to an output grid for each stagger
+    As with GridBounds, irow_o, icol_o, orow_e and ocol_e set the WRF window that is read
+    """
+    def __init__(self, in_grid, out_grid, method='bilinear', cache_dir=''):
+        if method not in methods:
+            raise ValueError('Unknown interpolation method %s' %method)
+        self.method = method
+        # The grid-relative winds are rotated between the projections
+        self.rotate_winds = not in_grid.same_proj(out_grid)
+        if self.rotate_winds:
+            self.angles = {'col': self._angles(in_grid, out_grid, False, True),
+              'row': self._angles(in_grid, out_grid, True, False)}
+        self.key = grid_key(in_grid, out_grid, method)
+        fn = ''
+        if cache_dir:
+            fn = os.path.join(cache_dir, 'weights_%s.npz' %self.key)
+        if self.key in loaded:
+            arrs = loaded[self.key]
+        elif fn and os.path.exists(fn):
+            print('Reading weights %s' %fn, flush=True)
+            with np.load(fn) as npz:
+                arrs = dict(npz)
+        else:
+            arrs = self._calc(in_grid, out_grid)
+            if fn:
+                print('Writing weights %s' %fn, flush=True)
+                os.makedirs(cache_dir, exist_ok=True)
+                tmp = '%s.%s.npz' %(fn[:-4], os.getpid())
+                np.savez(tmp, **arrs)
+                os.replace(tmp, fn)
+        loaded[self.key] = arrs
+        self._set_window(arrs)
+
+    def _points(self, out_grid, row_stag, col_stag, sub=1):
+        '''
+        Projected x and y of the output points with sub x sub samples across each output cell
+        Returns arrays shaped (points, samples)
+        '''
+        nrows = int(out_grid.NROWS) + int(row_stag)
+        ncols = int(out_grid.NCOLS) + int(col_stag)
+        offs = (np.arange(sub) + 0.5) / sub - 0.5
+        x = out_grid.XORIG + out_grid.XCELL * (np.arange(ncols)[:,None] + (0 if col_stag else 0.5) + offs)
+        y = out_grid.YORIG + out_grid.YCELL * (np.arange(nrows)[:,None] + (0 if row_stag else 0.5) + offs)
+        x = np.broadcast_to(x[None,:,None,:], (nrows, ncols, sub, sub))
+        y = np.broadcast_to(y[:,None,:,None], (nrows, ncols, sub, sub))
+        return x.reshape(nrows * ncols, sub * sub), y.reshape(nrows * ncols, sub * sub)
+
+    def _angles(self, in_grid, out_grid, row_stag, col_stag):
+        '''
+        Angle (radians) from the WRF grid north to the output grid north at the output points,
+        from the meridian convergence of each projection
+        '''
+        x, y = self._points(out_grid, row_stag, col_stag)
+        lon, lat = get_proj(out_grid.proj4())(x[:,0], y[:,0], inverse=True)
+        conv = get_proj(out_grid.proj4()).get_factors(lon, lat).meridian_convergence - \
+          get_proj(in_grid.proj4()).get_factors(lon, lat).meridian_convergence
+        shape = (int(out_grid.NROWS) + int(row_stag), int(out_grid.NCOLS) + int(col_stag))
+        return np.radians(conv).reshape(shape)
+
+    def _frac_index(self, in_grid, out_grid, row_stag, col_stag, sub=1, check=True):
+        '''
+        Fractional WRF row and column of each output point (sample)
+        '''
+        x, y = self._points(out_grid, row_stag, col_stag, sub)
+        lon, lat = get_proj(out_grid.proj4())(x, y, inverse=True)
+        x, y = get_proj(in_grid.proj4())(lon, lat)
+        row = (y - in_grid.YORIG) / in_grid.YCELL - (0 if row_stag else 0.5)
+        col = (x - in_grid.XORIG) / in_grid.XCELL - (0 if col_stag else 0.5)
+        nrows = int(in_grid.NROWS) + int(row_stag)
+        ncols = int(in_grid.NCOLS) + int(col_stag)
+        # Allow for the rounding of the WRF origin to the cell size. The area samples may
+        #  reach past the edges of the WRF domain and take the edge cells, as long as each
+        #  output cell has samples inside the WRF cells.
+        tol = 0.01
+        edge = tol if sub == 1 else 0.5
+        inside = (row >= -edge) & (col >= -edge) & (row <= nrows - 1 + edge) & (col <= ncols - 1 + edge)
+        if check and not inside.any(axis=1).all():
+            raise ValueError('Output grid %s is not inside the WRF domain' %str(out_grid.GDNAM).strip())
+        return np.clip(row, 0, nrows - 1), np.clip(col, 0, ncols - 1)
+
+    def _bilinear(self, row, col):
+        '''
+        Four point weights around each output point
+        '''
+        row, col = row[:,0], col[:,0]
+        row0 = np.clip(np.floor(row), 0, None).astype(np.int32)
+        col0 = np.clip(np.floor(col), 0, None).astype(np.int32)
+        # Keep the upper neighbor inside the grid, the weight of the lower point is then 1
+        row0 = np.where(row0 == row, np.maximum(row0 - 1, 0), row0)
+        col0 = np.where(col0 == col, np.maximum(col0 - 1, 0), col0)
+        tr = row - row0
+        tc = col - col0
+        rows = np.stack([row0, row0, row0 + 1, row0 + 1], axis=1)
+        cols = np.stack([col0, col0 + 1, col0, col0 + 1], axis=1)
+        wgts = np.stack([(1-tr)*(1-tc), (1-tr)*tc, tr*(1-tc), tr*tc], axis=1)
+        return rows, cols, wgts
+
+    def _area(self, row, col):
+        '''
+        Fraction of the samples across each output cell that fall in each WRF cell
+        '''
+        rows = np.rint(row).astype(np.int32)
+        cols = np.rint(col).astype(np.int32)
+        # Merge the samples that fall in the same WRF cell
+        flat = rows.astype(np.int64) * (cols.max() + 1) + cols
+        order = np.argsort(flat, axis=1)
+        flat = np.take_along_axis(flat, order, axis=1)
+        rows = np.take_along_axis(rows, order, axis=1)
+        cols = np.take_along_axis(cols, order, axis=1)
+        new = np.ones(flat.shape, bool)
+        new[:,1:] = flat[:,1:] != flat[:,:-1]
+        group = np.cumsum(new, axis=1) - 1
+        npts, nsamp = flat.shape
+        point = np.repeat(np.arange(npts), nsamp)
+        out_rows = np.zeros((npts, group.max() + 1), np.int32)
+        out_cols = np.zeros(out_rows.shape, np.int32)
+        wgts = np.zeros(out_rows.shape)
+        out_rows[point, group.ravel()] = rows.ravel()
+        out_cols[point, group.ravel()] = cols.ravel()
+        np.add.at(wgts, (point, group.ravel()), 1. / nsamp)
+        return out_rows, out_cols, wgts
+
+    def _calc(self, in_grid, out_grid):
+        '''
+        Calculate the absolute WRF rows, columns and weights of every output point by stagger
+        Categorical fields use the nearest WRF cell
+        '''
+        print('Calculating %s weights' %self.method, flush=True)
+        arrs = {}
+        for (row_stag, col_stag), name in staggers.items():
+            if self.method == 'area':
+                sub = 3 * int(np.ceil(float(out_grid.XCELL) / float(in_grid.XCELL)))
+                rows, cols, wgts = self._area(*self._frac_index(in_grid, out_grid, row_stag, col_stag, sub))
+            else:
+                rows, cols, wgts = self._bilinear(*self._frac_index(in_grid, out_grid, row_stag, col_stag))
+            arrs['%s_rows' %name] = rows
+            arrs['%s_cols' %name] = cols
+            arrs['%s_wgts' %name] = wgts.astype(np.float32)
+            arrs['%s_shape' %name] = np.array([int(out_grid.NROWS) + int(row_stag),
+              int(out_grid.NCOLS) + int(col_stag)])
+        # The area samples have already been checked, the nearest cell of an edge point is clipped
+        rows, cols = self._frac_index(in_grid, out_grid, False, False, check=self.method != 'area')
+        arrs['nearest_rows'] = np.rint(rows).astype(np.int32)
+        arrs['nearest_cols'] = np.rint(cols).astype(np.int32)
+        arrs['nearest_wgts'] = np.ones(rows.shape, np.float32)
+        arrs['nearest_shape'] = arrs['mass_shape']
+        return arrs
+
+    def _set_window(self, arrs):
+        '''
+        Set the WRF window covering every weight and the window-relative flat indices
+        '''
+        row_stag = {'mass': 0, 'row': 1, 'col': 0, 'nearest': 0}
+        col_stag = {'mass': 0, 'row': 0, 'col': 1, 'nearest': 0}
+        names = list(row_stag.keys())
+        self.irow_o = int(min(arrs['%s_rows' %name].min() for name in names))
+        self.icol_o = int(min(arrs['%s_cols' %name].min() for name in names))
+        # The staggered window has one more row or column than the unstaggered window
+        self.orow_e = int(max(arrs['%s_rows' %name].max() + 1 - row_stag[name] for name in names)) - self.irow_o
+        self.ocol_e = int(max(arrs['%s_cols' %name].max() + 1 - col_stag[name] for name in names)) - self.icol_o
+        self.weights = {}
+        for name in names:
+            ncols = self.ocol_e + col_stag[name]
+            idx = (arrs['%s_rows' %name] - self.irow_o) * ncols + arrs['%s_cols' %name] - self.icol_o
+            self.weights[name] = (idx, arrs['%s_wgts' %name], tuple(arrs['%s_shape' %name]))
+
+    def apply(self, arr, row_stag=False, col_stag=False, nearest=False):
+        '''
+        Interpolate an array windowed to this WRF window, with rows and cols last, to the output grid
+        '''
+        if nearest:
+            name = 'nearest'
+        else:
+            name = staggers[(row_stag, col_stag)]
+        idx, wgts, shape = self.weights[name]
+        flat = arr.reshape(arr.shape[:-2] + (-1,))
+        out = None
+        for k in range(idx.shape[1]):
+            part = flat[..., idx[:,k]] * wgts[:,k]
+            out = part if out is None else out + part
+        return out.reshape(arr.shape[:-2] + shape)
+
+    def rotate(self, u, v):
+        '''
+        Interpolate the windowed WRF U and V and rotate them to the output projection
+        '''
+        return rotate_winds(self.apply(u, col_stag=True), self.apply(v, row_stag=True), self.angles)
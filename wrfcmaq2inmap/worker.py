@@ -0,0 +1,150 @@
+# Long-running local worker that keeps the imports and run setup loaded between days
+#
+# Jobs are JSON lines, either a list of the command line arguments for one day or an
+#  object {"id": ..., "args": [...]}. Each job gets a JSON line reply with the status
+#  and run metrics. {"cmd": "stats"} reports on the worker and {"cmd": "shutdown"} stops it.
+
+import json
+import os
+import socketserver
+import sys
+import time
+import traceback
+from contextlib import redirect_stdout
+from optparse import OptionParser
+from wrfcmaq2inmap import cli
+from wrfcmaq2inmap.wrfsource import WRFCache
+
+class Worker:
+    """
+    Process day jobs in a single interpreter
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        # Load netCDF4, pandas, pyproj and the module-level VarDefs once
+        cli.load()
+        self.jobs = 0
+        self.failures = 0
+        # WRF hours shared by consecutive days, e.g. the 12Z file read by two day jobs
+        self.wrf_cache = WRFCache()
+        self.stopped = False
+
+    def handle_line(self, line):
+        '''
+        Run one JSON job line and return the reply dictionary
+        '''
+        try:
+            job = json.loads(line)
+        except ValueError as e:
+            return {'status': 'error', 'error': 'Invalid job: %s' %e}
+        if isinstance(job, dict) and 'cmd' in job:
+            return self.command(job)
+        if isinstance(job, dict):
+            return self.run_job(job.get('args', []), job.get('id'))
+        return self.run_job(job)
+
+    def command(self, job):
+        '''
+        Worker control commands
+        '''
+        if job['cmd'] == 'shutdown':
+            self.stopped = True
+            return dict(self.stats(), status='shutdown')
+        elif job['cmd'] == 'stats':
+            return dict(self.stats(), status='ok')
+        return {'status': 'error', 'error': 'Unknown command %s' %job['cmd']}
+
+    def stats(self):
+        return {'jobs': self.jobs, 'failures': self.failures,
+          'uptime_s': time.perf_counter() - self.start,
+          'wrf_cache_hits': self.wrf_cache.hits, 'wrf_hours_read': self.wrf_cache.reads,
+          'wrf_cached_slabs': len(self.wrf_cache.slabs)}
+
+    def run_job(self, argv, job_id=None):
+        '''
+        Process one day using the same arguments as the one-shot command line
+        '''
+        reply = {'id': job_id, 'args': argv}
+        self.jobs += 1
+        try:
+            options, args = cli.get_opts([str(arg) for arg in argv])
+            if len(args) != 5:
+                raise ValueError('Job needs wrfout metcro3d cmaq_conc rundate outfile')
+            if options.dry_run:
+                # Check the input headers only, as in the one-shot command line
+                from wrfcmaq2inmap.validate import run_checks
+                reply['check_errors'] = run_checks([tuple(args[:4]) + (options,),])
+                if reply['check_errors']:
+                    raise ValueError('Input check found %d errors' %reply['check_errors'])
+            else:
+                reply['metrics'] = cli.run_day(*args, options=options, wrf_cache=self.wrf_cache)
+        except SystemExit:
+            # optparse exits on bad options
+            self.failures += 1
+            reply.update(status='error', error='Invalid options %s' %argv)
+        except Exception as e:
+            self.failures += 1
+            traceback.print_exc()
+            reply.update(status='error', error='%s: %s' %(type(e).__name__, e))
+        else:
+            reply['status'] = 'ok'
+        return reply
+
+class _JobHandler(socketserver.StreamRequestHandler):
+    """
+    Read job lines from a socket connection and write back the replies
+    """
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            reply = self.server.worker.handle_line(line.decode())
+            self.wfile.write((json.dumps(reply) + '\n').encode())
+            self.wfile.flush()
+            if self.server.worker.stopped:
+                break
+
+def serve_stdin(worker):
+    '''
+    Read jobs from stdin and write the replies to stdout
+    The processing messages are sent to stderr to keep stdout for the replies
+    '''
+    out = sys.stdout
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        with redirect_stdout(sys.stderr):
+            reply = worker.handle_line(line)
+        out.write(json.dumps(reply) + '\n')
+        out.flush()
+        if worker.stopped:
+            break
+
+def serve_socket(worker, path):
+    '''
+    Serve jobs on a Unix socket, one job at a time
+    '''
+    if os.path.exists(path):
+        os.remove(path)
+    with socketserver.UnixStreamServer(path, _JobHandler) as server:
+        server.worker = worker
+        print('Listening on %s' %path, flush=True)
+        try:
+            while not worker.stopped:
+                server.handle_request()
+        finally:
+            os.remove(path)
+
+def serve(argv):
+    '''
+    Start the worker on stdin or a Unix socket
+    '''
+    parser = OptionParser(usage = 'usage: %prog serve [--socket path]')
+    parser.add_option('-s', '--socket', dest='socket', default='',
+      help='Path of the Unix socket to listen on. Jobs are read from stdin if not set.')
+    options, args = parser.parse_args(argv)
+    worker = Worker()
+    if options.socket:
+        serve_socket(worker, options.socket)
+    else:
+        serve_stdin(worker)
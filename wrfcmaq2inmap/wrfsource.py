@@ -0,0 +1,286 @@
+# Reading the 24 hours of a run date from one or more WRF output files
+#
+# Consecutive days share a WRF file: wrfout_d04_<day>_12:00:00 has the last 12 hours of one
+#  day and the first 12 hours of the next. With a WRFCache the windowed, layer-mapped slabs of
+#  the hours that belong to later days are kept between days so that each day only reads its
+#  new file.
+
+import numpy as np
+import netCDF4 as ncf
+
+def wrf_dates(times):
+    '''
+    Convert the WRF Times character array to a list of YYYYMMDDHH strings
+    '''
+    dates = []
+    for dt in times:
+        dt = ''.join([c.decode() for c in dt])
+        dates.append(dt[:4]+dt[5:7]+dt[8:10]+dt[11:13])
+    return dates
+
+class WRFCache:
+    """
+    Windowed WRF slabs by variable and date hour, carried between consecutive days
+    Each slab is kept with the path of the file it was read from and is only used while that
+    file is one of the files of the day.
+    """
+    def __init__(self):
+        self.key = None
+        # (path, slab) by variable and hour
+        self.slabs = {}
+        # (path, slab) of the time-invariant fields by variable, slab is None where the field
+        #  was found to change
+        self.static = {}
+        # Global attributes of the files that have been opened, by path
+        self.attrs = {}
+        self.hits = 0
+        self.reads = 0
+
+    def set_key(self, key):
+        '''
+        Clear the slabs if the window or the layer mapping changes
+        '''
+        if key != self.key:
+            self.key = key
+            self.slabs = {}
+            self.static = {}
+
+    def has_hour(self, hour, varnames, paths):
+        '''
+        Check that the hour of every variable is cached from one of the paths
+        '''
+        return all((varname, hour) in self.slabs and self.slabs[(varname, hour)][0] in paths
+          for varname in varnames)
+
+    def source(self, varname, hour):
+        return self.slabs.get((varname, hour), (None, None))[0]
+
+    def get(self, varname, hour):
+        self.hits += 1
+        return self.slabs[(varname, hour)][1]
+
+    def put(self, varname, hour, arr, path):
+        self.slabs[(varname, hour)] = (path, arr.copy())
+
+    def get_static(self, varname, paths):
+        '''
+        The cached time-invariant field read from one of the paths, (False, None) if there is none
+        A hit moves the field to the newest path, so it is kept while the files roll forward
+        '''
+        if varname in self.static and self.static[varname][0] in paths:
+            self.hits += 1
+            arr = self.static[varname][1]
+            self.static[varname] = (paths[-1], arr)
+            return True, arr
+        return False, None
+
+    def expire(self, rundate, paths):
+        '''
+        Drop the slabs for the hours before the run date, the slabs, static fields and headers
+        of other files
+        '''
+        first = str(rundate) + '00'
+        self.slabs = dict((k, v) for k, v in self.slabs.items() if k[1] >= first and v[0] in paths)
+        self.static = dict((k, v) for k, v in self.static.items() if v[0] in paths)
+        self.attrs = dict((k, v) for k, v in self.attrs.items() if k in paths)
+
+class WRFHours:
+    """
+    The 24 hours of a run date spread over one or more WRF output files, oldest first
+    Files are only opened when their hours are needed. The newest file is always opened and
+    is used for the grid definition, dimensions and variable attributes.
+    """
+    def __init__(self, wrf_files, rundate, cache=None, fill=None, hours=None):
+        self.files = list(wrf_files)
+        # FillPolicy for reading without the auto-masking
+        self.fill = fill
+        self.rundate = str(rundate)
+        # All 24 hours of the day or the listed hours
+        if hours is None:
+            hours = range(24)
+        self.hours = ['%s%0.2d' %(self.rundate, hour) for hour in hours]
+        self.cache = cache
+        self.records = {}
+        self._datasets = {}
+        if self.cache is not None:
+            self.cache.expire(self.rundate, self._paths())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        '''
+        Close the files opened here. Datasets passed in are left to the caller.
+        '''
+        for ds in self._datasets.values():
+            ds.close()
+        self._datasets = {}
+
+    def _paths(self):
+        return [self._path(idx) for idx in range(len(self.files))]
+
+    def _path(self, idx):
+        wrf = self.files[idx]
+        if isinstance(wrf, ncf.Dataset):
+            return wrf.filepath()
+        return wrf
+
+    def dataset(self, idx):
+        '''
+        Open a WRF file on first use
+        '''
+        wrf = self.files[idx]
+        if isinstance(wrf, ncf.Dataset):
+            ds = wrf
+            if self.fill is not None:
+                self.fill.prepare(ds)
+        elif idx in self._datasets:
+            ds = self._datasets[idx]
+        else:
+            print('Opening %s' %wrf, flush=True)
+            ds = ncf.Dataset(wrf)
+            if self.fill is not None:
+                self.fill.prepare(ds)
+            self._datasets[idx] = ds
+        if self.cache is not None and self._path(idx) not in self.cache.attrs:
+            self.cache.attrs[self._path(idx)] = dict((att, ds.getncattr(att)) for att in ds.ncattrs())
+        return ds
+
+    @property
+    def newest(self):
+        return self.dataset(len(self.files) - 1)
+
+    @property
+    def dimensions(self):
+        return self.newest.dimensions
+
+    @property
+    def variables(self):
+        return self.newest.variables
+
+    def _header(self):
+        # Global attributes come from the oldest file, as they would from ncrcat
+        path = self._path(0)
+        if self.cache is not None and path in self.cache.attrs:
+            return self.cache.attrs[path]
+        ds = self.dataset(0)
+        return dict((att, ds.getncattr(att)) for att in ds.ncattrs())
+
+    def ncattrs(self):
+        return list(self._header().keys())
+
+    def getncattr(self, name):
+        return self._header()[name]
+
+    def set_key(self, key):
+        '''
+        Set the window and layer key of any cached slabs
+        '''
+        if self.cache is not None:
+            self.cache.set_key(key)
+
+    def read_static(self, varname, lay_slice, row_slice, col_slice):
+        '''
+        Read a windowed field that is declared time-invariant once, as a single time step
+        The first and last records of the newest file are compared exactly to confirm it.
+        Returns None if the field changes over time.
+        '''
+        if self.cache is not None:
+            found, arr = self.cache.get_static(varname, self._paths())
+            if found:
+                return arr
+        var = self.newest.variables[varname]
+        if lay_slice is None:
+            idx = (row_slice, col_slice)
+        else:
+            idx = (lay_slice, row_slice, col_slice)
+        first = var[(0,) + idx]
+        last = var[(var.shape[0] - 1,) + idx]
+        if self.fill is not None:
+            first = self.fill.apply(var, first)
+            last = self.fill.apply(var, last)
+        if np.array_equal(np.ma.getdata(first), np.ma.getdata(last)) and \
+          np.array_equal(np.ma.getmaskarray(first), np.ma.getmaskarray(last)):
+            arr = first[None]
+        else:
+            print('WARNING: %s changes over time, reading every hour' %varname, flush=True)
+            arr = None
+        if self.cache is not None:
+            self.cache.reads += 2
+            self.cache.static[varname] = (self._path(len(self.files) - 1), arr)
+        return arr
+
+    def locate(self, varnames, key=None):
+        '''
+        Find the file and record for each hour of the run date that is not already cached
+        When caching, the hours after the run date in the files that are read are also read
+        and kept for the following days. The hours in the newest file are always read from it,
+        as they are without the cache, and the other hours are only taken from slabs of the
+        older files of the day.
+        '''
+        if self.cache is not None:
+            self.cache.set_key(key)
+            newest = wrf_dates(self.newest.variables['Times'])
+            older = self._paths()[:-1]
+            needed = [hour for hour in self.hours if hour in newest or
+              not self.cache.has_hour(hour, varnames, older)]
+        else:
+            needed = list(self.hours)
+        self.records = {}
+        # Search the newest file first as it is always opened
+        for idx in reversed(range(len(self.files))):
+            if not needed:
+                break
+            dates = wrf_dates(self.dataset(idx).variables['Times'])
+            found = [hour for hour in needed if hour in dates]
+            if not found:
+                continue
+            recs = [(hour, dates.index(hour)) for hour in found]
+            if self.cache is not None:
+                recs += [(hour, rec) for rec, hour in enumerate(dates) if hour > self.hours[-1] and
+                  not self.cache.has_hour(hour, varnames, [self._path(idx),])]
+            self.records[idx] = sorted(recs, key=lambda x: x[1])
+            needed = [hour for hour in needed if hour not in found]
+        if needed:
+            raise ValueError('Could not find %s in WRF' %needed[0])
+
+    def read(self, varname, lay_slice, row_slice, col_slice):
+        '''
+        Read the windowed variable for the 24 hours of the run date
+        lay_slice is None for variables without a layer dimension
+        '''
+        day = {}
+        for idx, recs in self.records.items():
+            var = self.dataset(idx).variables[varname]
+            rec_nums = [rec for hour, rec in recs]
+            if rec_nums == list(range(rec_nums[0], rec_nums[-1] + 1)):
+                rec_slice = slice(rec_nums[0], rec_nums[-1] + 1)
+            else:
+                # Only the listed records of a subset of the hours
+                rec_slice = rec_nums
+            if lay_slice is None:
+                arr = var[rec_slice,row_slice,col_slice]
+            else:
+                arr = var[rec_slice,lay_slice,row_slice,col_slice]
+            if self.fill is not None:
+                arr = self.fill.apply(var, arr)
+            if self.cache is not None:
+                self.cache.reads += len(recs)
+            for hour, rec in recs:
+                slab = arr[rec_nums.index(rec)]
+                if hour in self.hours:
+                    day[hour] = slab
+                elif self.cache.source(varname, hour) != self._path(idx):
+                    self.cache.put(varname, hour, slab, self._path(idx))
+        if len(self.records) == 1 and len(day) == len(self.hours) == arr.shape[0]:
+            # The whole day came from one contiguous read
+            return arr
+        for hour in self.hours:
+            if hour not in day:
+                day[hour] = self.cache.get(varname, hour)
+        if self.fill is None:
+            return np.ma.stack([day[hour] for hour in self.hours])
+        return np.stack([day[hour] for hour in self.hours])